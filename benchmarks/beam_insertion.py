@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+Compare beam insertion in the n-gram decoder.
+
+The shuffled sentences are re-ordered twice with ngram_decoder.generate():
+once with the heap-based ngram_decoder.Beam, and once with the original beam,
+in which every admitted candidate is appended to a list that is then sorted,
+reversed and truncated to the beam size. The script checks that both produce
+the same output and prints the decoding time of each.
+
+For example, on the PTB validation split (see
+ngram/NGram_replication_instructions.txt for the files):
+
+python beam_insertion.py ${OUTPUT_DIR}/LM5_noeos_withnpsyms_freq3_unkUNK.arpa \
+    ${DATA_DIR}/zgen_data_npsyms_freq3_unkUNK/npsyms/valid_words_with_np_symbols_shuffled_no_eos.txt \
+    512 --future ${OUTPUT_DIR}/LM1_noeos_withnpsyms_freq3_unkUNK.arpa
+
+"""
+
+import os
+import sys
+import argparse
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "ngram"))
+
+import kenlm
+import ngram_decoder
+
+class SortedBeam(object):
+    """
+    The original beam of ngram_decoder.generate(), with the interface of
+    ngram_decoder.Beam (without recombination). With a margin, hypotheses
+    that are not within margin of the best score are pruned, as in Beam.
+    """
+
+    def __init__(self, beam_size, recombine=False, margin=None):
+        assert not recombine
+        self.beam_size = beam_size
+        self.margin = margin
+        self.best = float("-inf")
+        self.beam = []
+        self.threshold = float("-inf")
+        self.admitted = 0
+        self.recombined = 0
+
+    @property
+    def heap(self):
+        """
+        The hypotheses held, as (total, hypothesis) pairs (for the --profile
+        statistics of ngram_decoder.Search).
+        """
+        return self.beam
+
+    def push(self, total, hyp):
+        self.admitted += 1
+        if self.margin is not None and total > self.best:
+            self.best = total
+            self.threshold = max(self.threshold, total - self.margin)
+        self.beam.append((total, hyp))
+        self.beam.sort(key=lambda a: a[0])
+        self.beam.reverse()
+        self.beam = self.beam[:self.beam_size]
+        if len(self.beam) == self.beam_size:
+            self.threshold = max(self.threshold, self.beam[-1][0])
+
+    def hypotheses(self):
+        if self.margin is not None:
+            return [hyp for total, hyp in self.beam
+                if total > self.best - self.margin]
+        return [hyp for total, hyp in self.beam]
+
+    def shrink(self, beam_size):
+        """
+        Reduce the beam size to beam_size, dropping the worst hypotheses.
+        """
+        self.beam_size = beam_size
+        self.beam = self.beam[:beam_size]
+        if len(self.beam) == beam_size:
+            self.threshold = max(self.threshold, self.beam[-1][0])
+
+def decode(lm, lines, beam_size, futurelm, no_npsyms_as_words):
+    outputs = []
+    start = time.time()
+    for l in lines:
+        bag = ngram_decoder.intern_bow(ngram_decoder.read_bow(l,
+            no_npsyms_as_words))
+        outputs.append(" ".join(ngram_decoder.generate(lm, bag, beam_size,
+            futurelm)))
+    return outputs, time.time() - start
+
+def main(arguments):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('lm', help="Language model", type=str)
+    parser.add_argument('test', help="Shuffled file (one sentence per line, no \
+        EOS symbols, to re-order.", type=str)
+    parser.add_argument('beamsize', help="Beam size to use.", type=int)
+    parser.add_argument('-f', '--future', help="LM for unigram future costs. \
+        If omitted, future costs are not calculated.", type=str, default="")
+    parser.add_argument('-n', '--no_npsyms_as_words',
+        help="Do not treat base NP symbols as words.", action="store_true")
+    parser.add_argument('-m', '--max_sentences', help="Only decode the first \
+        max_sentences lines of the test file.", type=int, default=0)
+
+    args = parser.parse_args(arguments)
+    lm = kenlm.Model(args.lm)
+
+    futurelm = None
+    if args.future != "":
+        futurelm = ngram_decoder.load_futurelm(args.future)
+
+    lines = open(args.test).readlines()
+    if args.max_sentences > 0:
+        lines = lines[:args.max_sentences]
+
+    heap_beam = ngram_decoder.Beam
+    results = {}
+    for name, beam_class in [("sorted", SortedBeam), ("heap", heap_beam)]:
+        ngram_decoder.Beam = beam_class
+        results[name] = decode(lm, lines, args.beamsize, futurelm,
+            args.no_npsyms_as_words)
+    ngram_decoder.Beam = heap_beam
+
+    assert results["sorted"][0] == results["heap"][0], \
+        "The heap and sorted beams produced different output"
+
+    print "sentences: %d, beam size: %d" % (len(lines), args.beamsize)
+    for name in ["sorted", "heap"]:
+        seconds = results[name][1]
+        print "%s: %.2f seconds (%.2f sentences/second)" % (name, seconds,
+            len(lines) / seconds)
+    print "speedup: %.2fx" % (results["sorted"][1] / results["heap"][1])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+Time ngram_decoder.generate() on synthetic sentences.
+
+Synthetic shuffled sentences of the given lengths (in words, not counting
+BNP symbols) are generated from the vocabulary of the unigram LM, with about
+bnp_density of their words in BNPs, and re-ordered with each of the beam
+sizes, with and without future costs. By default, the toy LMs in
+benchmarks/data are used, so the benchmark runs offline.
+
+Each configuration is run in a separate process, so that its peak resident
+set size can be measured. The results are written as a JSON object (one per
+line, so that the results of successive runs can be appended to the same
+file with --output) with, for each configuration: the sentences decoded per
+second, the calls to KenLM's BaseScore, the hypotheses expanded and the
+candidates scored per sentence, and the peak RSS in kilobytes. A summary is
+written to standard error. --engine selects the search engine of the
+decoder (see ngram_decoder.ENGINES), and --max_nodes, --node_budget and
+--recombine are passed to it.
+
+For example:
+
+python decoder_speed.py --output results.jsonl
+
+"""
+
+import os
+import sys
+import argparse
+import json
+import random
+import resource
+import subprocess
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "ngram"))
+
+import ngram_decoder
+
+# Symbols of the unigram LM that are not used as words of the sentences.
+SYMBOLS = set(["<s>", "</s>", "<unk>", "<sonp>", "<eonp>"])
+
+def synthetic_sentence(rng, vocabulary, length, bnp_density):
+    """
+    A shuffled sentence of length words drawn from vocabulary, with about
+    bnp_density of the words in BNPs of 2 to 4 words (which are shuffled as
+    atomic units), as a line of decoder input.
+    """
+    # A unit is a BNP (of 3 words on average) with probability p, so that
+    # 3p / (3p + 1 - p) of the words are in BNPs.
+    p = bnp_density / (3 - 2 * bnp_density)
+    units = []
+    words = 0
+    while words < length:
+        size = 1
+        if rng.random() < p:
+            size = min(rng.randint(2, 4), length - words)
+        unit = [rng.choice(vocabulary) for i in range(size)]
+        if size > 1:
+            unit = ["<sonp>"] + unit + ["<eonp>"]
+        units.append(unit)
+        words += size
+    rng.shuffle(units)
+    return " ".join(w for unit in units for w in unit)
+
+def synthetic_sentences(vocabulary, lengths, sentences, bnp_density, seed):
+    rng = random.Random(seed)
+    return [synthetic_sentence(rng, vocabulary, length, bnp_density)
+        for length in lengths for i in range(sentences)]
+
+def run_config(args):
+    """
+    Decode the sentences with one beam size, with or without future costs,
+    and print the results as JSON.
+    """
+    lm = ngram_decoder.load_lm(args.lm)
+    futuretable = ngram_decoder.FutureTable.from_arpa(args.future)
+    vocabulary = sorted(w for w in futuretable.words if w not in SYMBOLS)
+    lines = synthetic_sentences(vocabulary, args.lengths, args.sentences,
+        args.bnp_density, args.seed)
+    bags = [ngram_decoder.intern_bow(ngram_decoder.read_bow(l, False))
+        for l in lines]
+    futurelm = futuretable if args.with_future else None
+
+    options = {}
+    if args.engine == "astar":
+        options["max_nodes"] = args.max_nodes
+        options["node_budget"] = args.node_budget
+    stats = {}
+    start = time.time()
+    for bag in bags:
+        ngram_decoder.ENGINES[args.engine](lm, bag, args.beam_size, futurelm,
+            args.recombine, stats=stats, profile=True, **options)
+    seconds = time.time() - start
+
+    print json.dumps({
+        "beam_size": args.beam_size,
+        "future": args.with_future,
+        "sentences": len(bags),
+        "seconds": seconds,
+        "sentences_per_second": len(bags) / seconds,
+        "lm_calls_per_sentence": float(stats["lm_calls"]) / len(bags),
+        "expansions_per_sentence": float(stats["expansions"]) / len(bags),
+        "candidates_per_sentence": float(stats["candidates"]) / len(bags),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }, sort_keys=True)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=BENCHMARK_DIR, stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(arguments):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--lm', help="Language model (with BNP symbols).",
+        type=str, default=os.path.join(BENCHMARK_DIR, "data",
+        "toy_lm3_npsyms.arpa"))
+    parser.add_argument('--future', help="Unigram LM (arpa) for future \
+        costs, and the vocabulary of the sentences.", type=str,
+        default=os.path.join(BENCHMARK_DIR, "data", "toy_lm1_npsyms.arpa"))
+    parser.add_argument('--engine', help="Search engine of the decoder.",
+        choices=sorted(ngram_decoder.ENGINES), default="python")
+    parser.add_argument('--max_nodes', help="Maximum number of open nodes \
+        of the best-first search (with --engine astar).", type=int,
+        default=ngram_decoder.DEFAULT_MAX_NODES)
+    parser.add_argument('--node_budget', help="Maximum number of nodes \
+        scored by the best-first search of a sentence (with --engine astar). \
+        By default, %d times --max_nodes." % ngram_decoder.NODE_BUDGET_FACTOR,
+        type=int, default=None)
+    parser.add_argument('-r', '--recombine', help="Merge hypotheses with the \
+        same remaining bag and LM state (not with --engine numpy).",
+        action="store_true")
+    parser.add_argument('--beam_sizes', help="Comma-separated beam sizes.",
+        type=str, default="1,8,64,512")
+    parser.add_argument('--lengths', help="Comma-separated sentence lengths.",
+        type=str, default="10,20,30")
+    parser.add_argument('--sentences', help="Number of sentences of each \
+        length.", type=int, default=5)
+    parser.add_argument('--bnp_density', help="Approximate fraction of the \
+        words of each sentence that are in BNPs.", type=float, default=0.5)
+    parser.add_argument('--seed', help="Seed of the synthetic sentences.",
+        type=int, default=1776)
+    parser.add_argument('-o', '--output', help="File to which the results \
+        are appended. By default, they are written to standard out.",
+        type=str, default="")
+    # Used for the process of each configuration.
+    parser.add_argument('--beam_size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--with_future', action="store_true",
+        help=argparse.SUPPRESS)
+
+    args = parser.parse_args(arguments)
+    args.lengths = [int(n) for n in args.lengths.split(",")]
+    if args.max_nodes < 1:
+        parser.error("--max_nodes must be at least 1")
+    if args.node_budget is not None and args.node_budget < 1:
+        parser.error("--node_budget must be at least 1")
+    if args.engine == "numpy" and args.recombine:
+        parser.error("--engine numpy does not support --recombine")
+    if not 0 <= args.bnp_density < 1:
+        parser.error("--bnp_density must be in [0, 1)")
+    if args.beam_size is not None:
+        run_config(args)
+        return
+
+    common = ["--lm", args.lm, "--future", args.future, "--lengths",
+        ",".join(str(n) for n in args.lengths), "--sentences",
+        str(args.sentences), "--bnp_density", str(args.bnp_density),
+        "--seed", str(args.seed), "--engine", args.engine, "--max_nodes",
+        str(args.max_nodes)]
+    if args.node_budget is not None:
+        common.extend(["--node_budget", str(args.node_budget)])
+    if args.recombine:
+        common.append("--recombine")
+    results = []
+    for beam_size in [int(b) for b in args.beam_sizes.split(",")]:
+        for with_future in [False, True]:
+            command = [sys.executable, os.path.abspath(__file__),
+                "--beam_size", str(beam_size)] + common
+            if with_future:
+                command.append("--with_future")
+            result = json.loads(subprocess.check_output(command))
+            results.append(result)
+            sys.stderr.write("beam %d, %s: %.2f sentences/second, %.0f LM "
+                "calls/sentence, peak RSS %d KB\n" % (beam_size,
+                "future" if with_future else "no future",
+                result["sentences_per_second"],
+                result["lm_calls_per_sentence"], result["peak_rss_kb"]))
+
+    run = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "engine": args.engine,
+        "max_nodes": args.max_nodes,
+        "node_budget": args.node_budget,
+        "recombine": args.recombine,
+        "lm": os.path.basename(args.lm),
+        "future": os.path.basename(args.future),
+        "lengths": args.lengths,
+        "sentences": args.sentences,
+        "bnp_density": args.bnp_density,
+        "seed": args.seed,
+        "results": results,
+    }
+    line = json.dumps(run, sort_keys=True)
+    if args.output != "":
+        with open(args.output, "a") as f:
+            f.write(line + "\n")
+    else:
+        print line
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
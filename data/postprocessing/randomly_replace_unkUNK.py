@@ -8,6 +8,10 @@ un-preprocessed input.
 
 None of the input files should have an EOS symbol.
 
+The three files are read together, line by line, so large corpora are
+processed in constant memory. The replacements are random, but the same for
+every run (the random seed is fixed).
+
     
 """
 
@@ -16,7 +20,7 @@ import string
 
 import sys
 import argparse
-from collections import defaultdict
+from itertools import izip_longest
 import random
 
 random.seed(1776)
@@ -31,6 +35,11 @@ SONP_SYM = "<sonp>"
 EONP_SYM = "<eonp>"
 EOS_SYM = "<eos>"
 
+NP_SYMS = set([SONP_SYM, EONP_SYM])
+
+# Word groups that contain any of these symbols are replaced.
+REPLACED_SYMS = set(["unk", "UNK", NUMERIC_SYM])
+
 
 
 def token_contains_alpha(token):
@@ -80,6 +89,59 @@ def get_word_groups(sentence_tokens):
                 word_groups.append([token])
     return word_groups    
         
+def read_word_groups(path, option):
+    """
+    Iterate over the non-blank lines of path, each as a list of word groups
+    (see get_word_groups()). option names the file in assertion messages.
+    """
+    with open(path) as f:
+        for line in f:
+            if line not in string.whitespace:
+                line_split = line.split()
+                assert line_split[-1] != STACK_SEPARATOR, "%s should not include End-of-sentence symbols" % option
+                yield get_word_groups(line_split)
+
+def replace_symbols(gen_sent, gold_sent, gold_proc_sent, remove_npsyms):
+    """
+    Replace the unk, UNK and N word groups of a generated sentence with
+    randomly chosen gold word groups of the same sentence with the same
+    processed form, and return the output line.
+    """
+    assert len(gen_sent) == len(gold_sent) == len(gold_proc_sent)
+
+    # dictionary that maps each processed word group (a base NP or a single
+    # token) with unk_sym or UNK_sym or the NUMERIC_SYM to the gold word
+    # groups with that processed form. A base NP and a single token never
+    # have the same key, as the key of a base NP starts with SONP_SYM.
+    processed_word_group_to_gold = {}
+    for gold_word_group, processed_word_group in zip(gold_sent, gold_proc_sent):
+        assert len(gold_word_group) == len(processed_word_group)
+        assert len(processed_word_group) == 1 or processed_word_group[0] == SONP_SYM
+        if not REPLACED_SYMS.isdisjoint(processed_word_group):
+            processed_word_group_to_gold.setdefault(" ".join(processed_word_group), []).append(" ".join(gold_word_group))
+
+    reprocessed_generated_sent = []
+    for generated_word_group in gen_sent:
+        # each word group is a base NP or single token
+        assert len(generated_word_group) == 1 or generated_word_group[0] == SONP_SYM
+        key = " ".join(generated_word_group)
+        if not REPLACED_SYMS.isdisjoint(generated_word_group):
+            possible_matches = processed_word_group_to_gold.get(key, [])
+            idx = random.randint(0,len(possible_matches)-1)
+            reprocessed_generated_sent.append(possible_matches.pop(idx))
+            if len(possible_matches) == 0:
+                del processed_word_group_to_gold[key]
+        else:
+            reprocessed_generated_sent.append(key)
+
+    assert processed_word_group_to_gold == {}
+
+    if remove_npsyms:
+        reprocessed_generated_sent = [token for word_group in reprocessed_generated_sent for token in word_group.split() if token not in NP_SYMS]
+
+    reprocessed_generated_sent.append("\n")
+    return " ".join(reprocessed_generated_sent)
+
 def main(arguments):
 
     parser = argparse.ArgumentParser(description=__doc__,
@@ -92,107 +154,18 @@ def main(arguments):
     
     
     args = parser.parse_args(arguments)
-       
-    generated_file = args.generated_reordering_with_unk
-    gold_file = args.gold_unprocessed
-    gold_processed_file = args.gold_processed
-    out_file = args.out_file
-    unk_sym = "unk"
-    UNK_sym = "UNK"
-
-    remove_npsyms = args.remove_npsyms
-
-    generated_lines = []
-    with open(generated_file) as f:
-        for line in f:
-            if line not in string.whitespace:
-                line_split = line.split()
-                assert line_split[-1] != STACK_SEPARATOR, "--generated_reordering_with_unk should not include End-of-sentence symbols"
-                word_groups = get_word_groups(line_split)
-                generated_lines.append(word_groups)
-    
-    gold_lines = []
 
-    with open(gold_file) as f:
-        for line in f:
-            if line not in string.whitespace:
-                line_split = line.split()
-                assert line_split[-1] != STACK_SEPARATOR, "--gold_unprocessed should not include End-of-sentence symbols"
-                word_groups = get_word_groups(line_split)
-                gold_lines.append(word_groups)
-
-    gold_processed_lines = []
-
-    with open(gold_processed_file) as f:
-        for line in f:
-            if line not in string.whitespace:
-                line_split = line.split()
-                assert line_split[-1] != STACK_SEPARATOR, "--gold_processed should not include End-of-sentence symbols"
-                word_groups = get_word_groups(line_split)               
-                gold_processed_lines.append(word_groups)
-                                
-    assert len(generated_lines) == len(gold_lines) == len(gold_processed_lines)
-    
-    reprocessed_generated_sents = []
-
-    for gen_sent, gold_sent, gold_proc_sent in zip(generated_lines, gold_lines, gold_processed_lines):
-        assert len(gen_sent) == len(gold_sent) == len(gold_proc_sent)
-        
-        # dictionary that maps processed base NPs to gold base NPs (only 
-        # processed base NPs with unk_sym or UNK_sym or the NUMERIC_SYM are included)
-        processed_np_word_group_to_gold = defaultdict(list)
-        # other processed groups:
-        processed_word_group_to_gold = defaultdict(list)
-        for gold_word_group, processed_word_group in zip(gold_sent, gold_proc_sent):
-            assert len(gold_word_group) == len(processed_word_group)
-            if len(processed_word_group) == 1:
-                if (unk_sym in processed_word_group or UNK_sym in processed_word_group or NUMERIC_SYM in processed_word_group):
-                    processed_word_group_to_gold[" ".join(processed_word_group)].append(gold_word_group)                
-            else:
-                assert processed_word_group[0] == SONP_SYM 
-                if (unk_sym in processed_word_group or UNK_sym in processed_word_group or NUMERIC_SYM in processed_word_group):
-                    processed_np_word_group_to_gold[" ".join(processed_word_group)].append(gold_word_group)
-
-        reprocessed_generated_sent = []
-        for generated_word_group in gen_sent:
-            # each word group is a base NP or single token 
-            if len(generated_word_group) == 1:
-                if (unk_sym in generated_word_group or UNK_sym in generated_word_group or NUMERIC_SYM in generated_word_group):
-                    possible_matches = processed_word_group_to_gold[" ".join(generated_word_group)]
-                    idx = random.randint(0,len(possible_matches)-1)
-                    reprocessed_generated_sent.append(" ".join(possible_matches[idx]))
-                    del processed_word_group_to_gold[" ".join(generated_word_group)][idx]
-                    if len(processed_word_group_to_gold[" ".join(generated_word_group)]) == 0:
-                        del processed_word_group_to_gold[" ".join(generated_word_group)]
-                else:
-                    reprocessed_generated_sent.append(" ".join(generated_word_group))
-            else:
-                assert generated_word_group[0] == SONP_SYM
-                if (unk_sym in generated_word_group or UNK_sym in generated_word_group or NUMERIC_SYM in generated_word_group):
-                    possible_matches = processed_np_word_group_to_gold[" ".join(generated_word_group)]
-                    idx = random.randint(0,len(possible_matches)-1)
-                    reprocessed_generated_sent.append(" ".join(possible_matches[idx]))
-                    del processed_np_word_group_to_gold[" ".join(generated_word_group)][idx]   
-                    if len(processed_np_word_group_to_gold[" ".join(generated_word_group)]) == 0:
-                        del processed_np_word_group_to_gold[" ".join(generated_word_group)]                 
-                else:
-                    reprocessed_generated_sent.append(" ".join(generated_word_group))
-                    
-        assert processed_word_group_to_gold == {} and processed_np_word_group_to_gold == {}
-        
-        reprocessed_generated_sent_no_npsyms = []
-        if remove_npsyms:
-            for word_group in reprocessed_generated_sent:
-                for token in word_group.split():
-                    if token not in [SONP_SYM, EONP_SYM]:
-                        reprocessed_generated_sent_no_npsyms.append(token)
-            reprocessed_generated_sent = reprocessed_generated_sent_no_npsyms
-            
-        reprocessed_generated_sent.append("\n")
-        reprocessed_generated_sents.append(" ".join(reprocessed_generated_sent))
-        
-    with open(out_file, "w") as f:
-        f.writelines(reprocessed_generated_sents) 
+    # The three files are read in step, one sentence at a time, and each
+    # output line is written as soon as it is made.
+    sentences = izip_longest(
+        read_word_groups(args.generated_reordering_with_unk, "--generated_reordering_with_unk"),
+        read_word_groups(args.gold_unprocessed, "--gold_unprocessed"),
+        read_word_groups(args.gold_processed, "--gold_processed"))
+
+    with open(args.out_file, "w") as f:
+        for gen_sent, gold_sent, gold_proc_sent in sentences:
+            assert gen_sent is not None and gold_sent is not None and gold_proc_sent is not None, "The input files do not have the same number of sentences"
+            f.write(replace_symbols(gen_sent, gold_sent, gold_proc_sent, args.remove_npsyms))
         
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
@@ -7,7 +7,10 @@ Generate/re-order with an n-gram language model
 
 An arpa formatted language model (as for example, a Kneser-Ney LM generated by
 KenLM) is used to re-order a shuffled sentence. Optionally, a unigram LM can
-be used for future costs. 
+be used for future costs. The future cost of a hypothesis is computed
+incrementally (and exactly), rather than by summing the costs of the
+remaining words, so where hypotheses are tied up to rounding, the output can
+differ from that of the original (version 0.21) decoder.
 
 BNPs, if used, should be marked with:
     a start symbol: <sonp>
@@ -25,6 +28,31 @@ without base NP symbols.
 
 The KenLM Python bindings are required.
 
+The n-gram model can be an arpa file or a KenLM binary (probing or trie)
+model, which loads much faster and with less memory. With --binary, the arpa
+file is converted once with KenLM's build_binary, and the binary model is
+cached next to it (and rebuilt only if the arpa file changes). --load_method
+sets how KenLM loads a binary model: lazy memory-maps it and pages it in on
+demand (so workers and concurrent decoders share the same pages), populate
+memory-maps and pre-reads it, and read reads it into memory.
+
+With --engine numpy (which requires NumPy), each step of the beam search is
+scored and pruned with NumPy array operations, which is faster for large
+beams. The output is the same, except where exactly tied hypotheses are
+pruned or ordered differently.
+
+With --engine astar, each sentence is re-ordered with a best-first (A*)
+search instead: the hypothesis with the best score plus future score is
+expanded first, until the best one is complete. With --astar_weight above 1
+(weighted A*), the future score counts for more, and the search is greedier.
+--max_nodes bounds the number of open hypotheses (100000 by default), and
+--node_budget the number of hypotheses scored (5 times --max_nodes by
+default), after which the best open hypothesis is completed greedily.
+--recombine (which merges hypotheses with the same remaining bag and LM
+state) keeps the search tractable for longer sentences. The number of
+hypotheses expanded by each search is recorded by --profile, for all
+engines.
+
 Neither the input nor the LM training files should contain explicit EOS symbols.
 
 The input file must be pre-shuffled. For consistency with past work in this
@@ -34,7 +62,39 @@ special tokens and the post-processing script should be used to randomly
 replace these from remaining unused words before calculating BLEU. 
 See the repo README for additional details.
 
-The re-ordered output is printed to standard out.
+The re-ordered output is printed to standard out, one sentence at a time. If
+the input file is -, the input is read from standard in. With --output FILE,
+each output line is also appended to FILE together with its line index, as
+soon as it is decoded. If FILE already exists, for example from a run that
+crashed or was preempted, the lines it contains are not decoded again. (They
+are still printed to standard out, so the printed output is complete.)
+
+With --workers N, sentences are decoded in N worker processes (in chunks of
+--chunk_size lines), which share the language models loaded by the parent
+process. The output order (and content) is the same as for the serial decoder.
+With --schedule cost, the whole input is read first, and the sentences are
+decoded in order of decreasing estimated cost (see estimated_cost()), one
+batch per worker at a time, so that the longest sentences are not left to
+the end. The output is still printed in input order, but each line is
+written to the --output file (and its n-best list to the --nbest_file) as
+soon as it is decoded.
+
+The decoder can also be used as a library, which keeps the models loaded
+between sentences:
+
+    decoder = ngram_decoder.Decoder.load(lm_path, future_path)
+    words = decoder.reorder(shuffled_tokens, beam_size)
+
+With --serve PORT, the models are loaded once and sentences are re-ordered on
+demand by a local HTTP server (the test file argument is ignored). Each POST
+request holds shuffled lines in the input format, one per line, and the
+response holds the re-ordered lines. The beam size of a request can be set
+with a beam_size query parameter. For example:
+
+    curl --data-binary @shuffled.txt "http://localhost:PORT/?beam_size=64"
+
+Requests are handled concurrently, and with --workers N, decoded by N worker
+processes.
 
 """
 
@@ -42,15 +102,191 @@ import os
 import sys
 import argparse
 import kenlm
-import copy
+import heapq
+import itertools
+import json
+import csv
+import hashlib
 from collections import namedtuple
 import math
+import multiprocessing
+import subprocess
+import signal
+import time
+import BaseHTTPServer
+import SocketServer
+import urlparse
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
+# future_units is the exact future score (see fixed_point()).
 Hypothesis = namedtuple("Hypothesis", ['score', 'last_action', "bow", 
-    "future_score", "state", "last_beam"])
+    "future_score", "state", "last_beam", "future_units"])
+
+class Beam(object):
+    """
+    A beam of at most beam_size hypotheses, kept as a min-heap on the
+    hypothesis score plus future score. A candidate can only enter the beam
+    if its score is higher than threshold, which is -inf until the beam is
+    full and the score of the worst hypothesis in the beam after that.
+
+    This keeps the same hypotheses, in the same order, as appending each
+    candidate to a list that is then sorted (stably), reversed and truncated.
+    That procedure reverses the order of tied hypotheses with every insertion,
+    so after t insertions, tied hypotheses that were inserted at an insertion
+    number with the same parity as t come first (latest first), followed by
+    the others (earliest first).
+
+    With recombine, hypotheses with the same remaining bag and the same LM
+    state are merged, keeping the best one. Replaced hypotheses are only
+    marked as dead in the heap, and skipped when they reach the top.
+
+    With a margin, hypotheses are also pruned if their score is not within
+    margin of the best score in the beam, and threshold is at least the best
+    score minus margin.
+    """
 
-def batch_advance(lm, inner_states, w, out_states):
+    def __init__(self, beam_size, recombine=False, margin=None):
+        self.beam_size = beam_size
+        self.margin = margin
+        self.best = float("-inf")
+        self.heap = []
+        self.threshold = float("-inf")
+        self.pushed = 0
+        self.recombine = recombine
+        self.entries = {}
+        self.dead = set()
+        self.admitted = 0
+        self.recombined = 0
+
+    def pop(self):
+        entry = heapq.heappop(self.heap)
+        while entry[1] in self.dead:
+            self.dead.remove(entry[1])
+            entry = heapq.heappop(self.heap)
+        return entry
+
+    def push(self, total, hyp):
+        self.admitted += 1
+        if self.margin is not None and total > self.best:
+            self.best = total
+            self.threshold = max(self.threshold, total - self.margin)
+        if self.recombine:
+            key = (hyp.bow, hyp.state)
+            old = self.entries.get(key)
+            if old is not None:
+                self.recombined += 1
+                if total <= old[0]:
+                    return
+                self.dead.add(old[1])
+        self.pushed += 1
+        entry = (total, self.pushed, hyp)
+        if self.recombine:
+            self.entries[key] = entry
+        if len(self.heap) - len(self.dead) < self.beam_size:
+            heapq.heappush(self.heap, entry)
+            if len(self.heap) - len(self.dead) < self.beam_size:
+                return
+        else:
+            # Drop the last of the (tied) worst hypotheses.
+            worst = [self.pop()]
+            while True:
+                # Dead entries are cleared off the top first, so that only
+                # live entries tied with the worst one are gathered.
+                while self.heap and self.heap[0][1] in self.dead:
+                    self.dead.remove(heapq.heappop(self.heap)[1])
+                if not self.heap or self.heap[0][0] != worst[0][0]:
+                    break
+                worst.append(heapq.heappop(self.heap))
+            parity = self.pushed % 2
+            other = [e for e in worst if e[1] % 2 != parity]
+            if other:
+                dropped = max(other)
+            else:
+                dropped = min(worst)
+            worst.remove(dropped)
+            if self.recombine:
+                del self.entries[(dropped[2].bow, dropped[2].state)]
+            for e in worst:
+                heapq.heappush(self.heap, e)
+            heapq.heappush(self.heap, entry)
+        while self.heap[0][1] in self.dead:
+            self.dead.remove(heapq.heappop(self.heap)[1])
+        self.threshold = max(self.heap[0][0], self.best - self.margin) \
+            if self.margin is not None else self.heap[0][0]
+
+    def hypotheses(self):
+        """
+        Return the hypotheses in the beam, best first.
+        """
+        parity = self.pushed % 2
+        def key(entry):
+            if entry[1] % 2 == parity:
+                return (entry[0], 1, entry[1])
+            return (entry[0], 0, -entry[1])
+        live = [entry for entry in self.heap if entry[1] not in self.dead]
+        if self.margin is not None:
+            live = [entry for entry in live
+                if entry[0] > self.best - self.margin]
+        return [entry[2] for entry in sorted(live, key=key, reverse=True)]
+
+    def shrink(self, beam_size):
+        """
+        Reduce the beam size to beam_size, dropping the worst hypotheses.
+        """
+        self.beam_size = beam_size
+        while len(self.heap) - len(self.dead) > beam_size:
+            dropped = self.pop()
+            if self.recombine:
+                del self.entries[(dropped[2].bow, dropped[2].state)]
+        while self.heap and self.heap[0][1] in self.dead:
+            self.dead.remove(heapq.heappop(self.heap)[1])
+        if len(self.heap) - len(self.dead) == beam_size:
+            self.threshold = max(self.threshold, self.heap[0][0])
+
+# A per-sentence search budget: the wall-clock seconds and the number of
+# candidate expansions after which the beams that have not been expanded yet
+# are reduced to beam_size hypotheses. seconds or expansions can be None.
+Budget = namedtuple("Budget", ["seconds", "expansions", "beam_size"])
+
+class ScoreCache(object):
+    """
+    A memo table of lm.BaseScore() calls, mapping (state, word) to
+    (score, out_state), with counts of hits and misses. The table is cleared
+    whenever it grows beyond size entries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+
+def batch_advance(lm, inner_states, w, out_states, cache=None):
     probs = []
+
+    if cache is not None:
+        table = cache.table
+        misses = 0
+        for state in inner_states:
+            key = (state, w)
+            value = table.get(key)
+            if value is None:
+                out_state = kenlm.State()
+                value = (lm.BaseScore(state, w, out_state), out_state)
+                table[key] = value
+                misses += 1
+            probs.append(value[0])
+            out_states.append(value[1])
+        cache.hits += len(inner_states) - misses
+        cache.misses += misses
+        if len(table) > cache.size:
+            table.clear()
+        return probs
     
     for state in inner_states:
         out_states.append(kenlm.State())
@@ -58,85 +294,1511 @@ def batch_advance(lm, inner_states, w, out_states):
     
     return probs
 
-def future(action, word_set, futurelm):
+def action_future_costs(bag, futurelm):
     """
-    Pre-condition: action has been removed from word_set
+    The future cost of each action of bag, from futurelm (a FutureTable or a
+    BigramFuture), or 0 if futurelm is None. The future cost of a hypothesis
+    is that of its parent minus the cost of its last action.
     """
-    score = 0
-    if futurelm != {}:
-        for words, c in word_set.iteritems():
-            if c == 0: continue
-            for i, w in enumerate(words):
-                score += futurelm[w] * c
+    if futurelm is None:
+        return [0.0] * len(bag.actions)
+    return futurelm.action_costs(bag)
 
-    return score
+def fixed_point(values):
+    """
+    Write floats as integer multiples of a common power of two. Sums of the
+    integers are exact, so a sum converts back to the same float, with
+    math.ldexp(total, exponent), whatever the order of its terms. Returns
+    the integers and the exponent.
+    """
+    parts = [math.frexp(v) for v in values]
+    exponent = min([e for m, e in parts if m != 0] or [0]) - 53
+    units = []
+    for m, e in parts:
+        if m == 0:
+            units.append(0)
+        else:
+            units.append(int(math.ldexp(m, 53)) << (e - 53 - exponent))
+    return units, exponent
+
+def action_inside_scores(lm, action):
+    """
+    The words of an action after its first lm.order - 1 words are scored in
+    a context made up only of words of the action, so their scores (and the
+    LM state after the action) are the same for every hypothesis. Returns
+    those scores and that state, or None if the action is not long enough.
+    """
+    context = lm.order - 1
+    if len(action) <= context:
+        return None
+
+    state = kenlm.State()
+    lm.NullContextWrite(state)
+    scores = []
+    for i, w in enumerate(action):
+        out_state = kenlm.State()
+        score = lm.BaseScore(state, w, out_state)
+        if i >= context:
+            scores.append(score)
+        state = out_state
+    return scores, state
+
+def sentence_tables(lm, bag, futurelm, profile=None):
+    """
+    Precompute, for each action of bag: its words as strings, the words that
+    have to be scored for each hypothesis (see action_inside_scores()), the
+    inside scores, and the exact future cost (see fixed_point()). Returns
+    these lists and the exponent of the future costs. If profile is a
+    dictionary, the time and LM calls spent are added to it.
+    """
+    if profile is not None:
+        start = time.time()
+    # The LM is queried with the words of each action as strings, as KenLM's
+    # Python module has no way to query it by vocabulary index.
+    action_words = [tuple(bag.words[w] for w in action)
+        for action in bag.actions]
+    inside_scores = [action_inside_scores(lm, a) for a in action_words]
+    if profile is not None:
+        add_stat(profile, "lm_calls", sum([len(words) for words, inside
+            in zip(action_words, inside_scores) if inside is not None]))
+        add_stat(profile, "lm_seconds", time.time() - start)
+        start = time.time()
+    advance_words = []
+    for k, words in enumerate(action_words):
+        if inside_scores[k] is not None:
+            words = words[:len(words) - len(inside_scores[k][0])]
+        advance_words.append(words)
+    # Future scores are kept exact, so that hypotheses with the same remaining
+    # bag have the same future score. They can differ in the last bits from a
+    # float sum over the remaining bag (as the decoder first computed them),
+    # so (nearly) tied hypotheses can be ordered and pruned differently.
+    future_units, exponent = fixed_point(action_future_costs(bag, futurelm))
+    if profile is not None:
+        add_stat(profile, "future_seconds", time.time() - start)
+    return action_words, advance_words, inside_scores, future_units, exponent
+
+def add_stat(stats, key, value):
+    stats[key] = stats.get(key, 0) + value
+
+def max_stat(stats, key, value):
+    stats[key] = max(stats.get(key, 0), value)
+
+def budget_exhausted(budget, start_time, expanded):
+    """
+    Whether a search that started at start_time and has expanded expanded
+    candidates has exhausted the Budget budget (which can be None).
+    """
+    if budget is None:
+        return False
+    if budget.expansions is not None and expanded >= budget.expansions:
+        return True
+    return budget.seconds is not None \
+        and time.time() - start_time >= budget.seconds
+
+def record_fallback(stats, steps):
+    if stats is not None:
+        stats["fallbacks"] = stats.get("fallbacks", 0) + 1
+        stats["fallback_steps"] = stats.get("fallback_steps", 0) + steps
+
+def finish_beam(beam, stats):
+    if stats is not None:
+        stats["admitted"] = stats.get("admitted", 0) + beam.admitted
+        stats["recombined"] = stats.get("recombined", 0) + beam.recombined
+    return beam.hypotheses()
+
+def advance_batch(lm, queries, cache=None):
+    """
+    Advance the LM states of the expansions of a search step, given as a list
+    of (states, words) queries, by the words of each, one word position at a
+    time. The queries can come from the steps of several searches, and each
+    distinct (state, word) pair of a step is scored with the LM only once
+    (and, with the ScoreCache cache, only if it is not cached). Returns a
+    [scores, out states, LM calls] list for each query.
+    """
+    table = {} if cache is None else cache.table
+    results = [[[0.0] * len(states), states, 0] for states, words in queries]
+    length = max([len(words) for states, words in queries] or [0])
+    for r in range(length):
+        for (states, words), result in zip(queries, results):
+            if r >= len(words):
+                continue
+            w = words[r]
+            scores = result[0]
+            out_states = []
+            calls = 0
+            for j, state in enumerate(result[1]):
+                key = (state, w)
+                value = table.get(key)
+                if value is None:
+                    out_state = kenlm.State()
+                    value = (lm.BaseScore(state, w, out_state), out_state)
+                    table[key] = value
+                    calls += 1
+                scores[j] += value[0]
+                out_states.append(value[1])
+            result[1] = out_states
+            result[2] += calls
+            if cache is not None:
+                cache.hits += len(states) - calls
+                cache.misses += calls
+                if len(table) > cache.size:
+                    table.clear()
+    return results
+
+class Search(object):
+    """
+    The beam search of one Bag, run one step at a time, so that the steps of
+    the searches of several sentences can be run together (see
+    generate_batch()).
+    """
+
+    def __init__(self, lm, bag, beam_size, futurelm, recombine=False,
+        stats=None, margin=None, budget=None, profile=False):
+        self.bag = bag
+        self.stats = stats
+        self.profile = stats if profile else None
+        self.budget = budget
+        self.start_time = time.time()
+        self.expanded = 0
+        self.fallback = False
+        actions = bag.actions
+        self.n = sum([c*len(action) for action, c in zip(actions, bag.counts)])
+        start_state = kenlm.State()
+        lm.BeginSentenceWrite(start_state)
+
+        (self.action_words, self.advance_words, self.inside_scores,
+            self.future_units, self.exponent) = sentence_tables(lm, bag,
+            futurelm, self.profile)
+        units = sum(c * u for c, u in zip(bag.counts, self.future_units))
+
+        # Hypotheses keep their last action as an index into actions, and
+        # their remaining bag as a tuple of counts, indexed like actions. The
+        # tuple of a candidate is only built if it enters a beam.
+        self.beams = {}
+        self.beams[0] = [Hypothesis(0, None, bag.counts,
+            math.ldexp(units, self.exponent), start_state, None, units)]
+        for i in range(1, self.n+1):
+            self.beams[i] = Beam(beam_size, recombine, margin)
+        # Once beam i has been expanded, only the back-pointers of its
+        # hypotheses (the index of the parent in its beam, and the last
+        # action) are kept, in parents[i] and last_actions[i], and the
+        # hypotheses (with their bags and LM states) are released.
+        self.parents = {}
+        self.last_actions = {}
+        hyp = self.beams[0][0]
+        self.hypothesis_bytes = sys.getsizeof(hyp) + sys.getsizeof(hyp.bow) \
+            + sys.getsizeof(hyp.state)
+
+    def expansions(self, i):
+        """
+        Finish beam i, and return the expansions of step i: a list of
+        (action, hypotheses, states) tuples, with the indices and LM states
+        of the hypotheses of beam i in which the action is available.
+
+        If the budget is exhausted, the beams from beam i on are first
+        reduced to the fallback beam size of the budget, so the rest of the
+        search is (with a beam size of 1) a greedy completion of the best
+        hypotheses so far.
+        """
+        if not self.fallback and budget_exhausted(self.budget,
+            self.start_time, self.expanded):
+            self.fallback = True
+            for j in range(max(i, 1), self.n+1):
+                self.beams[j].shrink(self.budget.beam_size)
+            record_fallback(self.stats, self.n - i)
+        if i > 0:
+            self.beams[i] = finish_beam(self.beams[i], self.stats)
+        beam = self.beams[i]
+        if self.profile is not None:
+            add_stat(self.profile, "expansions", len(beam))
+        expansions = []
+        for k in range(len(self.bag.actions)):
+            available = [j for j, hyp in enumerate(beam) if hyp.bow[k] > 0]
+            if available:
+                expansions.append((k, available,
+                    [beam[j].state for j in available]))
+        return expansions
+
+    def queries(self, expansions):
+        """
+        The (states, words) LM queries of expansions, for advance_batch().
+        """
+        return [(states, self.advance_words[k])
+            for k, available, states in expansions]
+
+    def expand(self, i, expansions, results):
+        """
+        Add the candidates of the expansions of step i to the following
+        beams, given the advance_batch() result of each expansion.
+        """
+        beam = self.beams[i]
+        for (k, available, states), result in zip(expansions, results):
+            self.expanded += len(available)
+            scores, inner_states = result[0], result[1]
+            inside = self.inside_scores[k]
+            if inside is not None:
+                for new_score in inside[0]:
+                    for new_score_i in range(len(scores)):
+                        scores[new_score_i] += new_score
+                inner_states = [inside[1]] * len(available)
+
+            # Add to beam.
+            next_beam = self.beams[i + len(self.bag.actions[k])]
+            cost = self.future_units[k]
+            exponent = self.exponent
+
+            for avail_i, j in enumerate(available):
+                hyp = beam[j]
+                score = scores[avail_i]
+                out_state = inner_states[avail_i]
+
+                units = hyp.future_units - cost
+                fscore = math.ldexp(units, exponent)
+                total = hyp.score+score+fscore
+                if total > next_beam.threshold:
+                    new_bow = hyp.bow[:k] + (hyp.bow[k] - 1,) + hyp.bow[k+1:]
+                    new_hyp = Hypothesis(hyp.score+score, k, new_bow,
+                        fscore, out_state, j, units)
+                    next_beam.push(total, new_hyp)
+
+        del self.beams[i]
+        if i > 0:
+            self.parents[i] = array("i", [hyp.last_beam for hyp in beam])
+            self.last_actions[i] = array("i",
+                [hyp.last_action for hyp in beam])
+
+    def record_profile(self):
+        """
+        Record the number of hypotheses held in the beams that have not been
+        expanded yet and of back-pointers kept, with an estimate of their
+        size.
+        """
+        held = 0
+        for beam in self.beams.itervalues():
+            held += len(beam) if isinstance(beam, list) else len(beam.heap)
+        pointers = sum([len(p) for p in self.parents.itervalues()])
+        max_stat(self.profile, "peak_hypotheses", held)
+        max_stat(self.profile, "peak_bytes", held * self.hypothesis_bytes
+            + pointers * 2 * array("i").itemsize)
+
+    def result(self, nbest=0):
+        """
+        Finish the last beam, and return the words of its best hypothesis in
+        order, or with nbest, a list of the (words, score, future score) of
+        its nbest best hypotheses.
+        """
+        n = self.n
+        if n > 0:
+            self.beams[n] = finish_beam(self.beams[n], self.stats)
+        if self.profile is not None:
+            add_stat(self.profile, "candidates", self.expanded)
+            add_stat(self.profile, "seconds", time.time() - self.start_time)
+
+        if nbest == 0:
+            return self.backtrack(0)
+        return [(self.backtrack(pos), hyp.score, hyp.future_score)
+            for pos, hyp in enumerate(self.beams[n][:nbest])]
+
+    def backtrack(self, pos):
+        """
+        The words, in order, of hypothesis pos of the last beam.
+        """
+        order = []
+        cur = self.n
+        if cur > 0:
+            last_action = self.beams[cur][pos].last_action
+            pos = self.beams[cur][pos].last_beam
+        while cur > 0:
+            order.extend(reversed(self.action_words[last_action]))
+            cur -= len(self.bag.actions[last_action])
+            if cur > 0:
+                last_action = self.last_actions[cur][pos]
+                pos = self.parents[cur][pos]
+
+        order.reverse()
+        return order
+
+def generate_batch(lm, bags, beam_size, futurelm, recombine=False, stats=None,
+    cache=None, margin=None, budget=None, profile=False, nbest=0):
+    """
+    Re-order several Bags with beam searches run in lockstep: at each step,
+    the LM queries of all of the searches are made together (see
+    advance_batch()). Returns the words of each bag in order (or with nbest,
+    its n-best list), which are the same as those returned by generate() for
+    each bag alone.
+
+    beam_size can also be a list, with the beam size of each bag. stats, if
+    given, is a list with a statistics dictionary for each bag (see
+    generate()). The LM queries that are answered by another query of the
+    same step (or by the ScoreCache cache) are counted as cache hits, if
+    cache is given. The time budget of each search includes the time spent
+    on the other searches of the batch, and with profile, the time spent on
+    the LM queries of a step is divided between the searches by their
+    number of queries.
+    """
+    if stats is None:
+        stats = [None] * len(bags)
+    if not isinstance(beam_size, list):
+        beam_size = [beam_size] * len(bags)
+    searches = [Search(lm, bag, bag_beam_size, futurelm, recombine,
+        bag_stats, margin, budget, profile)
+        for bag, bag_beam_size, bag_stats in zip(bags, beam_size, stats)]
+
+    for i in range(max([search.n for search in searches] or [0])):
+        active = [search for search in searches if i < search.n]
+        expansions = []
+        for search in active:
+            if search.profile is not None:
+                start_time = time.time()
+            expansions.append(search.expansions(i))
+            if search.profile is not None:
+                add_stat(search.profile, "beam_seconds",
+                    time.time() - start_time)
+        queries = []
+        for search, search_expansions in zip(active, expansions):
+            queries.extend(search.queries(search_expansions))
+        if profile:
+            start_time = time.time()
+        results = advance_batch(lm, queries, cache)
+        if profile:
+            lm_seconds = time.time() - start_time
+            step_lookups = sum([len(states) * len(words)
+                for states, words in queries])
+
+        start = 0
+        for search, search_expansions in zip(active, expansions):
+            end = start + len(search_expansions)
+            if search.profile is not None:
+                start_time = time.time()
+            search.expand(i, search_expansions, results[start:end])
+            if search.profile is not None:
+                add_stat(search.profile, "beam_seconds",
+                    time.time() - start_time)
+                search.record_profile()
+                lookups = sum([len(states) * len(words)
+                    for states, words in queries[start:end]])
+                add_stat(search.profile, "lm_seconds",
+                    lm_seconds * lookups / max(step_lookups, 1))
+                add_stat(search.profile, "lm_calls",
+                    sum([result[2] for result in results[start:end]]))
+            if search.stats is not None and cache is not None:
+                search_queries = queries[start:end]
+                calls = sum([result[2] for result in results[start:end]])
+                lookups = sum([len(states) * len(words)
+                    for states, words in search_queries])
+                search.stats["lm_cache_hits"] = \
+                    search.stats.get("lm_cache_hits", 0) + lookups - calls
+                search.stats["lm_cache_misses"] = \
+                    search.stats.get("lm_cache_misses", 0) + calls
+            start = end
+
+    return [search.result(nbest) for search in searches]
+
+def generate(lm, bag, beam_size, futurelm, recombine=False, stats=None,
+    cache=None, margin=None, budget=None, profile=False, nbest=0):
+    """
+    Re-order a Bag with a beam search, and return the words in order.
+    futurelm is the FutureTable used for future costs, or None to not use
+    future costs. With a margin, the hypotheses of each beam whose score
+    (plus future score) is not within margin of the best one are pruned.
+    With a Budget budget, the beam size is reduced once the search has used
+    it up (see Search.expansions()), so the search finishes quickly. With
+    nbest, a list of the (words, LM score, future score) of the nbest best
+    hypotheses of the last beam is returned instead (best first); only those
+    hypotheses are backtracked.
+
+    If stats is a dictionary, the number of hypotheses admitted to the beams
+    and the number of those that were recombined (with recombine) are added
+    to it, as are the hits and misses of the ScoreCache cache (if any) and,
+    if the budget was exhausted, the fallbacks and the number of steps
+    decoded with the fallback beam size. With profile, the calls to
+    lm.BaseScore(), the hypotheses expanded and the candidates scored (their
+    expansions), the time spent on LM queries,
+    future costs and the beams, and the peak number (and estimated size) of
+    the hypotheses held are added to it too.
+    """
+    return generate_batch(lm, [bag], beam_size, futurelm, recombine, [stats],
+        cache, margin, budget, profile, nbest)[0]
+
+def scheduled_beam_size(beam_size, bag, beam_per_word=0):
+    """
+    The beam size used for bag: beam_size, or if beam_per_word is positive,
+    beam_per_word times the number of words in bag (rounded up), up to
+    beam_size.
+    """
+    if beam_per_word <= 0:
+        return beam_size
+    n = sum([c*len(action) for action, c in zip(bag.actions, bag.counts)])
+    return max(1, min(beam_size, int(math.ceil(beam_per_word * n))))
+
+def select_numpy(candidates, beam_size, margin=None):
+    """
+    Select the (at most) beam_size best of the candidates of a beam, given
+    as a list of tuples of arrays (totals, scores, future units, bags,
+    states, parents, actions), and return them as one such tuple, best
+    first. With a margin, only the candidates within margin of the best one
+    are selected.
+    """
+    columns = [np.concatenate(c) for c in zip(*candidates)]
+    totals = columns[0]
+    keep = np.arange(len(totals))
+    if len(totals) > beam_size:
+        keep = np.argpartition(-totals, beam_size - 1)[:beam_size]
+    keep = keep[np.lexsort((keep, -totals[keep]))]
+    if margin is not None:
+        keep = keep[totals[keep] > totals[keep[0]] - margin]
+    return [c[keep] for c in columns]
+
+def generate_numpy(lm, bag, beam_size, futurelm, recombine=False, stats=None,
+    cache=None, margin=None, budget=None, profile=False, nbest=0):
+    """
+    The beam search of generate(), with the candidates of each step scored
+    and selected with NumPy array operations. The LM scores of the beam
+    (hypotheses x actions) are computed once per distinct LM state of the
+    beam and action (KenLM can only be queried one word at a time), the
+    future scores are added, unavailable actions are masked out, and the
+    best beam_size candidates for each following beam are selected with
+    argpartition. Recombination is not supported.
+
+    The scores are computed as in generate(), so the output is the same,
+    except that exactly tied hypotheses may be kept or ordered differently.
+    """
+    if np is None:
+        raise ImportError("The numpy engine requires NumPy")
+    if recombine:
+        raise ValueError("The numpy engine does not support recombination")
+
+    actions = bag.actions
+    num_actions = len(actions)
+    lengths = [len(action) for action in actions]
+    n = sum([c*l for c, l in zip(bag.counts, lengths)])
+    if n == 0:
+        return [([], 0.0, 0.0)] if nbest else []
+    start_time = time.time()
+    expanded = 0
+    fallback = False
+    profile = stats if profile else None
+
+    if cache is not None:
+        cache_hits, cache_misses = cache.hits, cache.misses
+    (action_words, advance_words, inside_scores, future_units,
+        exponent) = sentence_tables(lm, bag, futurelm, profile)
+    initial_units = sum(c * u for c, u in zip(bag.counts, future_units))
+    # The future units of every bag are at most initial_units in magnitude.
+    # If they do not fit in an int64, they are rounded to a coarser exponent.
+    shift = max(0, abs(initial_units).bit_length() - 62)
+    if shift > 0:
+        future_units = [(u + (1 << (shift - 1))) >> shift
+            for u in future_units]
+        initial_units = sum(c * u for c, u in zip(bag.counts, future_units))
+        exponent += shift
+    action_units = np.array(future_units, dtype=np.int64)
+    columns_by_length = {}
+    for k, length in enumerate(lengths):
+        columns_by_length.setdefault(length, []).append(k)
+    for length in columns_by_length:
+        columns_by_length[length] = np.array(columns_by_length[length])
 
-def generate(lm, bow, beam_size, futurelm):
-    
-    n = sum([v*len(action) for action, v in bow.iteritems()])
     start_state = kenlm.State()
     lm.BeginSentenceWrite(start_state)
 
-    order = []
-    beams = {}
-    beams[0] = [Hypothesis(0, None, bow, future(None, bow, futurelm), 
-        start_state, None)]
-        
-    for i in range(1, n+1):
-        beams[i] = []
+    # The current beam, as parallel arrays (and a list of LM states).
+    scores = np.zeros(1)
+    units = np.array([initial_units], dtype=np.int64)
+    bags = np.array([bag.counts], dtype=np.int32)
+    states = [start_state]
+    # Back-pointers (parent index and action) of the hypotheses of each beam.
+    parents = {}
+    last_actions = {}
+    # Candidates for the beams that have not been expanded yet.
+    candidates = dict((i, []) for i in range(1, n+1))
 
     for i in range(n):
+        if profile is not None:
+            step_time = time.time()
+        if not fallback and budget_exhausted(budget, start_time, expanded):
+            fallback = True
+            beam_size = budget.beam_size
+            record_fallback(stats, n - i)
+        if i > 0:
+            if not candidates[i]:
+                del candidates[i]
+                continue
+            (totals, scores, units, bags, states, parents[i],
+                last_actions[i]) = select_numpy(candidates.pop(i), beam_size,
+                margin)
+            if stats is not None:
+                stats["admitted"] = stats.get("admitted", 0) + len(totals)
 
-        states = []
-        
-        for j, hyp in enumerate(beams[i]):
-            states.append(hyp.state)
-            
-        for action in bow:
-            # Advance
-            inner_states = states
-            scores = [0.0] * len(beams[i])
-            
-            for w in action:
-                out_states = []
-                new_scores = batch_advance(lm, inner_states, w, out_states)
-                inner_states = out_states
+        size = len(scores)
+        available = bags > 0
+        expanded += int(available.sum())
+        if profile is not None:
+            add_stat(profile, "expansions", size)
+
+        # The distinct LM states of the beam.
+        state_ids = np.empty(size, dtype=np.intp)
+        distinct = {}
+        distinct_states = []
+        for j, state in enumerate(states):
+            u = distinct.get(state)
+            if u is None:
+                u = distinct[state] = len(distinct_states)
+                distinct_states.append(state)
+            state_ids[j] = u
+
+        if profile is not None:
+            lm_time = time.time()
+            add_stat(profile, "beam_seconds", lm_time - step_time)
+            lm_calls = 0 if cache is None else -cache.misses
+        lm_scores = np.zeros((size, num_actions))
+        out_states = np.empty((size, num_actions), dtype=object)
+        for k in range(num_actions):
+            rows = np.flatnonzero(available[:, k])
+            if len(rows) == 0:
+                continue
+            needed = np.unique(state_ids[rows])
+            if profile is not None and cache is None:
+                lm_calls += len(needed) * len(advance_words[k])
+            inner_states = [distinct_states[u] for u in needed]
+            action_scores = [0.0] * len(needed)
+            for w in advance_words[k]:
+                out = []
+                new_scores = batch_advance(lm, inner_states, w, out, cache)
+                inner_states = out
                 for new_score_i, new_score in enumerate(new_scores):
-                    scores[new_score_i] += new_score
+                    action_scores[new_score_i] += new_score
+            inside = inside_scores[k]
+            if inside is not None:
+                for new_score in inside[0]:
+                    for new_score_i in range(len(action_scores)):
+                        action_scores[new_score_i] += new_score
+                inner_states = [inside[1]] * len(needed)
 
-            # Add to beam.
-            ni = i + len(action)
-            
-            for j, hyp in enumerate(beams[i]):
-                score = scores[j]
-                out_state = inner_states[j]
-                
-                if hyp.bow[action] == 0:
-                    continue
-                
-                new_bow = copy.copy(hyp.bow)
-                new_bow[action] -= 1
-                fscore = future(action, new_bow, futurelm)               
-                if len(beams[ni]) < beam_size or (hyp.score+score+fscore
-                    > beams[ni][-1].score + beams[ni][-1].future_score):
- 
-                    new_hyp = Hypothesis(hyp.score+score, action, new_bow, 
-                        fscore, out_state, j)
-                    beams[ni].append(new_hyp)
-                    beams[ni].sort(key=lambda a: a.score + a.future_score)
-                    beams[ni].reverse()
-                    beams[ni] = beams[ni][:beam_size]
-
-    cur = n
-    pos = 0
-    while cur > 0:
-        order.extend(reversed(beams[cur][pos].last_action))
-        old_cur = cur
-        cur -= len(beams[cur][pos].last_action)
-        pos = beams[old_cur][pos].last_beam
-
-    order.reverse()
-    return order
+            score_by_state = np.zeros(len(distinct_states))
+            score_by_state[needed] = action_scores
+            state_by_state = np.empty(len(distinct_states), dtype=object)
+            for u, out_state in zip(needed, inner_states):
+                state_by_state[u] = out_state
+            lm_scores[rows, k] = score_by_state[state_ids[rows]]
+            out_states[rows, k] = state_by_state[state_ids[rows]]
+
+        if profile is not None:
+            step_time = time.time()
+            add_stat(profile, "lm_seconds", step_time - lm_time)
+            add_stat(profile, "lm_calls", lm_calls if cache is None
+                else lm_calls + cache.misses)
+
+        new_scores = scores[:, None] + lm_scores
+        new_units = units[:, None] - action_units[None, :]
+        totals = new_scores + np.ldexp(new_units.astype(np.float64), exponent)
+        totals[~available] = -np.inf
+
+        for length, columns in columns_by_length.iteritems():
+            ni = i + length
+            if ni > n:
+                continue
+            flat = totals[:, columns].ravel()
+            chosen = np.flatnonzero(flat > -np.inf)
+            if len(chosen) > beam_size:
+                chosen = chosen[np.argpartition(-flat[chosen],
+                    beam_size - 1)[:beam_size]]
+            if len(chosen) == 0:
+                continue
+            rows, column_ids = np.divmod(chosen, len(columns))
+            chosen_actions = columns[column_ids]
+            child_bags = bags[rows]
+            child_bags[np.arange(len(rows)), chosen_actions] -= 1
+            candidates[ni].append((flat[chosen],
+                new_scores[rows, chosen_actions],
+                new_units[rows, chosen_actions], child_bags,
+                out_states[rows, chosen_actions], rows.astype(np.int32),
+                chosen_actions.astype(np.int32)))
+
+        if profile is not None:
+            add_stat(profile, "beam_seconds", time.time() - step_time)
+            held = sum([len(a) for a in parents.itervalues()]) + sum([
+                len(c[0]) for beam in candidates.itervalues() for c in beam])
+            max_stat(profile, "peak_hypotheses", held)
+            # Scores, units, parent and action, bag and LM state.
+            max_stat(profile, "peak_bytes", held * (32 + bags.itemsize
+                * num_actions + sys.getsizeof(start_state)))
+
+    (totals, scores, units, bags, states, parents[n],
+        last_actions[n]) = select_numpy(candidates.pop(n), beam_size, margin)
+    if profile is not None:
+        add_stat(profile, "candidates", expanded)
+        add_stat(profile, "seconds", time.time() - start_time)
+    if stats is not None:
+        stats["admitted"] = stats.get("admitted", 0) + len(totals)
+        if cache is not None:
+            stats["lm_cache_hits"] = stats.get("lm_cache_hits", 0) \
+                + cache.hits - cache_hits
+            stats["lm_cache_misses"] = stats.get("lm_cache_misses", 0) \
+                + cache.misses - cache_misses
+
+    def backtrack(pos):
+        order = []
+        cur = n
+        while cur > 0:
+            k = last_actions[cur][pos]
+            order.extend(reversed(action_words[k]))
+            pos = parents[cur][pos]
+            cur -= lengths[k]
+        order.reverse()
+        return order
+
+    if nbest == 0:
+        return backtrack(0)
+    return [(backtrack(pos), float(scores[pos]),
+        math.ldexp(int(units[pos]), exponent))
+        for pos in range(min(nbest, len(scores)))]
+
+# The default bound on the open nodes of the best-first search, and the
+# default bound on the nodes it scores, as a multiple of the former.
+DEFAULT_MAX_NODES = 100000
+NODE_BUDGET_FACTOR = 5
+
+def generate_astar(lm, bag, beam_size, futurelm, recombine=False, stats=None,
+    cache=None, margin=None, budget=None, profile=False, nbest=0, weight=1.0,
+    max_nodes=DEFAULT_MAX_NODES, node_budget=None):
+    """
+    Re-order a Bag with a best-first (A*) search instead of a beam search:
+    the open node (hypothesis) with the highest score plus weight times its
+    future score is expanded first, and the search stops once that node is
+    complete. With a weight of 1 and admissible future costs, this finds the
+    best ordering; with a higher weight (weighted A*), the search is greedier
+    and expands fewer nodes. beam_size is not used. Margins are not
+    supported.
+
+    With recombine, a node is not added if a node with the same remaining
+    bag and LM state has been reached with a score at least as high, which
+    is needed for all but short sentences. The open list is cut back to the
+    max_nodes best nodes whenever it grows to twice that, after which the
+    search is no longer exact, and with recombine, the scores of the closed
+    nodes are forgotten whenever they number 4 max_nodes (so those nodes can
+    be reached and expanded again).
+
+    Once node_budget nodes (NODE_BUDGET_FACTOR times max_nodes, if None)
+    have been scored, or the Budget budget is used up, the best open node is
+    completed greedily (the fallback beam size is not used). As every node
+    kept has been scored, this also bounds the back-pointers. With nbest,
+    the first nbest complete nodes reached are returned, as in generate().
+
+    The statistics are those of generate(), with the expanded nodes (rather
+    than the hypotheses of each beam) as expansions.
+    """
+    if margin is not None:
+        raise ValueError("The astar engine does not support thresholds")
+    if node_budget is None:
+        node_budget = NODE_BUDGET_FACTOR * max_nodes
+
+    actions = bag.actions
+    n = sum([c*len(action) for action, c in zip(actions, bag.counts)])
+    if n == 0:
+        return [([], 0.0, 0.0)] if nbest else []
+    start_time = time.time()
+    profile = stats if profile else None
+    if cache is not None:
+        cache_hits, cache_misses = cache.hits, cache.misses
+
+    (action_words, advance_words, inside_scores, future_units,
+        exponent) = sentence_tables(lm, bag, futurelm, profile)
+    search_time = time.time()
+    units = sum(c * u for c, u in zip(bag.counts, future_units))
+    start_state = kenlm.State()
+    lm.BeginSentenceWrite(start_state)
+    root = Hypothesis(0, None, bag.counts, math.ldexp(units, exponent),
+        start_state, None, units)
+
+    # Back-pointers (the parent node and last action) of each node, by node
+    # id. The open list holds (-priority, node id, length, hypothesis)
+    # entries, so ties are expanded in the order they were added.
+    parents = array("i", [-1])
+    last_actions = array("i", [-1])
+    open_nodes = [(-root.future_score * weight, 0, 0, root)]
+    best = {}
+    if recombine:
+        best[(root.bow, root.state)] = root.score
+    counts = {"candidates": 0, "expansions": 0, "admitted": 0,
+        "recombined": 0, "lm_calls": 0, "lm_seconds": 0.0, "peak": 1}
+
+    def children(node, hyp):
+        """
+        Expand a node, and return its (action, child hypothesis) pairs.
+        """
+        available = [k for k in range(len(actions)) if hyp.bow[k] > 0]
+        if profile is not None:
+            lm_time = time.time()
+        results = advance_batch(lm, [([hyp.state], advance_words[k])
+            for k in available], cache)
+        if profile is not None:
+            counts["lm_seconds"] += time.time() - lm_time
+        counts["expansions"] += 1
+        counts["candidates"] += len(available)
+        pairs = []
+        for k, result in zip(available, results):
+            counts["lm_calls"] += result[2]
+            score, out_state = result[0][0], result[1][0]
+            inside = inside_scores[k]
+            if inside is not None:
+                for new_score in inside[0]:
+                    score += new_score
+                out_state = inside[1]
+            child_units = hyp.future_units - future_units[k]
+            new_bow = hyp.bow[:k] + (hyp.bow[k] - 1,) + hyp.bow[k+1:]
+            pairs.append((k, Hypothesis(hyp.score + score, k, new_bow,
+                math.ldexp(child_units, exponent), out_state, node,
+                child_units)))
+        return pairs
+
+    def add_node(k, hyp):
+        parents.append(hyp.last_beam)
+        last_actions.append(k)
+        return len(parents) - 1
+
+    goals = []
+    wanted = max(nbest, 1)
+    while open_nodes and len(goals) < wanted:
+        if counts["candidates"] >= node_budget or budget_exhausted(budget,
+            start_time, counts["candidates"]):
+            break
+        priority, node, length, hyp = heapq.heappop(open_nodes)
+        if length == n:
+            goals.append((node, hyp))
+            continue
+        if recombine and best.get((hyp.bow, hyp.state),
+            hyp.score) > hyp.score:
+            continue
+        for k, child in children(node, hyp):
+            counts["admitted"] += 1
+            if recombine:
+                key = (child.bow, child.state)
+                if key in best:
+                    counts["recombined"] += 1
+                    if child.score <= best[key]:
+                        continue
+                best[key] = child.score
+            heapq.heappush(open_nodes, (-(child.score
+                + weight * child.future_score), add_node(k, child),
+                length + len(actions[k]), child))
+        counts["peak"] = max(counts["peak"], len(open_nodes))
+        if len(open_nodes) >= 2 * max_nodes:
+            # A sorted list is a heap.
+            open_nodes.sort()
+            for entry in open_nodes[max_nodes:]:
+                hyp = entry[3]
+                if recombine and best.get((hyp.bow, hyp.state)) == hyp.score:
+                    del best[(hyp.bow, hyp.state)]
+            del open_nodes[max_nodes:]
+        if recombine and len(best) >= 4 * max_nodes:
+            # Forget the scores of the closed nodes, keeping those of the
+            # open nodes.
+            best = {}
+            for entry in open_nodes:
+                hyp = entry[3]
+                key = (hyp.bow, hyp.state)
+                best[key] = max(best.get(key, hyp.score), hyp.score)
+
+    if len(goals) < wanted and open_nodes:
+        # The budget is used up: complete the best open nodes greedily.
+        fallback_steps = n - open_nodes[0][2]
+        while open_nodes and len(goals) < wanted:
+            priority, node, length, hyp = heapq.heappop(open_nodes)
+            while length < n:
+                pairs = children(node, hyp)
+                k, hyp = max(pairs, key=lambda pair: (pair[1].score
+                    + weight * pair[1].future_score, -pair[0]))
+                node = add_node(k, hyp)
+                length += len(actions[k])
+            goals.append((node, hyp))
+        record_fallback(stats, fallback_steps)
+
+    if stats is not None:
+        add_stat(stats, "admitted", counts["admitted"])
+        add_stat(stats, "recombined", counts["recombined"])
+        if cache is not None:
+            add_stat(stats, "lm_cache_hits", cache.hits - cache_hits)
+            add_stat(stats, "lm_cache_misses", cache.misses - cache_misses)
+    if profile is not None:
+        for key in ["candidates", "expansions", "lm_calls", "lm_seconds"]:
+            add_stat(profile, key, counts[key])
+        add_stat(profile, "seconds", time.time() - start_time)
+        add_stat(profile, "beam_seconds", time.time() - search_time
+            - counts["lm_seconds"])
+        max_stat(profile, "peak_hypotheses", counts["peak"])
+        max_stat(profile, "peak_bytes", counts["peak"] * (sys.getsizeof(root)
+            + sys.getsizeof(root.bow) + sys.getsizeof(root.state))
+            + len(parents) * 2 * array("i").itemsize)
+
+    def backtrack(node):
+        order = []
+        while node > 0:
+            order.extend(reversed(action_words[last_actions[node]]))
+            node = parents[node]
+        order.reverse()
+        return order
+
+    if nbest == 0:
+        return backtrack(goals[0][0])
+    return [(backtrack(node), hyp.score, hyp.future_score)
+        for node, hyp in goals]
+
+# Search implementations, by --engine name. Each is called as
+# generate(lm, bag, beam_size, futurelm, recombine, stats, cache, margin,
+# budget, profile, nbest), and can take further keyword options (see
+# Decoder.engine_options()).
+ENGINES = {
+    "python": generate,
+    "numpy": generate_numpy,
+    "astar": generate_astar,
+}
+
+# KenLM load methods for binary models, by --load_method name.
+LOAD_METHODS = {
+    "lazy": kenlm.LoadMethod.LAZY,
+    "populate_or_lazy": kenlm.LoadMethod.POPULATE_OR_LAZY,
+    "populate": kenlm.LoadMethod.POPULATE_OR_READ,
+    "read": kenlm.LoadMethod.READ,
+}
+
+def binary_lm_path(arpa_path, binary_type):
+    """
+    The path of the cached binary model of an arpa file.
+    """
+    base = arpa_path
+    if base.endswith(".arpa"):
+        base = base[:-len(".arpa")]
+    return "%s.%s.binary" % (base, binary_type)
+
+def build_binary_lm(arpa_path, binary_type="trie", build_binary="build_binary"):
+    """
+    Convert an arpa file to a KenLM binary model of type binary_type (probing
+    or trie) with KenLM's build_binary, unless an up-to-date conversion is
+    already cached next to the arpa file. Returns the path of the binary
+    model.
+    """
+    path = binary_lm_path(arpa_path, binary_type)
+    if (os.path.exists(path)
+        and os.path.getmtime(path) >= os.path.getmtime(arpa_path)):
+        return path
+
+    # Build under a temporary name, so that a concurrent decoder never loads
+    # a partially written model.
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    subprocess.check_call([build_binary, binary_type, arpa_path, temp_path],
+        stdout=sys.stderr)
+    os.rename(temp_path, path)
+    return path
+
+def load_lm(path, load_method="lazy"):
+    """
+    Load an arpa or KenLM binary model. load_method is a key of LOAD_METHODS.
+    """
+    config = kenlm.Config()
+    config.load_method = LOAD_METHODS[load_method]
+    return kenlm.Model(path, config)
+
+class FutureTable(object):
+    """
+    The unigram log probabilities used for future costs: vocab maps each word
+    to an id, which indexes the array costs.
+    """
+
+    def __init__(self, words, costs):
+        self.words = words
+        self.vocab = dict((w, i) for i, w in enumerate(words))
+        self.costs = costs
+
+    @staticmethod
+    def from_arpa(path):
+        words = []
+        costs = array("d")
+        for l in open(path):
+            t = l.strip().split()
+            if len(t) == 2 and t[0] != "ngram":
+                words.append(t[1])
+                costs.append(float(t[0]))
+        return FutureTable(words, costs)
+
+    @staticmethod
+    def load(path):
+        """
+        Load a table saved with save().
+        """
+        with open(path, "rb") as f:
+            header = f.readline().split()
+            assert header[:2] == ["future_table", "1"], \
+                "%s is not a future cost table" % path
+            size, vocab_bytes = int(header[2]), int(header[3])
+            words = f.read(vocab_bytes).split("\n")[:size]
+            costs = array("d")
+            costs.fromfile(f, size)
+        return FutureTable(words, costs)
+
+    def action_costs(self, bag):
+        """
+        The unigram future cost of each action of bag.
+        """
+        word_costs = [self.costs[self.vocab[w]] for w in bag.words]
+        costs = []
+        for action in bag.actions:
+            cost = 0.0
+            for w in action:
+                cost += word_costs[w]
+            costs.append(cost)
+        return costs
+
+    def save(self, path):
+        """
+        Save the table as a header line, the words (one per line) and the
+        costs as raw doubles.
+        """
+        vocab = "".join(w + "\n" for w in self.words)
+        with open(path, "wb") as f:
+            f.write("future_table 1 %d %d\n" % (len(self.words), len(vocab)))
+            f.write(vocab)
+            self.costs.tofile(f)
+
+class BigramFuture(object):
+    """
+    Future costs estimated, for each sentence, with the LM used for search:
+    the first word of each action is scored after the best (for it) of the
+    sentence start and the last words of the other actions in the bag, and
+    its other words after the words before them in the action. These
+    estimates are much closer to the actual scores than unigram costs
+    (though, like those, they are not strictly admissible with a backoff
+    LM), and take (actions x actions) LM queries per sentence.
+    """
+
+    def __init__(self, lm):
+        self.lm = lm
+
+    def action_costs(self, bag):
+        lm = self.lm
+        words = bag.words
+        start_state = kenlm.State()
+        lm.BeginSentenceWrite(start_state)
+        # The state after each word that ends an action.
+        contexts = {}
+        for action in bag.actions:
+            if action[-1] not in contexts:
+                state = kenlm.State()
+                lm.NullContextWrite(state)
+                contexts[action[-1]] = kenlm.State()
+                lm.BaseScore(state, words[action[-1]], contexts[action[-1]])
+
+        # The scores of each first word after the start and each context.
+        first_scores = {}
+        for action in bag.actions:
+            w = action[0]
+            if w not in first_scores:
+                first_scores[w] = {None: lm.BaseScore(start_state, words[w],
+                    kenlm.State())}
+                for v, state in contexts.iteritems():
+                    first_scores[w][v] = lm.BaseScore(state, words[w],
+                        kenlm.State())
+
+        costs = []
+        for k, action in enumerate(bag.actions):
+            # An action can only follow itself if it occurs more than once.
+            allowed = [None] + [other[-1]
+                for other_k, other in enumerate(bag.actions)
+                if other_k != k or bag.counts[k] > 1]
+            cost = max(first_scores[action[0]][v] for v in allowed)
+            state = kenlm.State()
+            lm.NullContextWrite(state)
+            for i, w in enumerate(action):
+                out_state = kenlm.State()
+                score = lm.BaseScore(state, words[w], out_state)
+                if i > 0:
+                    cost += score
+                state = out_state
+            costs.append(cost)
+        return costs
+
+def load_futurelm(path):
+    """
+    Read the unigram log probabilities used for future costs from an arpa
+    file. The table is cached next to the arpa file (unless that is not
+    possible), and read from there while the arpa file does not change.
+    """
+    cache_path = path
+    if cache_path.endswith(".arpa"):
+        cache_path = cache_path[:-len(".arpa")]
+    cache_path += ".future_table"
+    if (os.path.exists(cache_path)
+        and os.path.getmtime(cache_path) >= os.path.getmtime(path)):
+        return FutureTable.load(cache_path)
+
+    futurelm = FutureTable.from_arpa(path)
+    temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    try:
+        futurelm.save(temp_path)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Could not cache the future cost table: %s\n" % e)
+    return futurelm
+
+def read_bow(line, no_npsyms_as_words):
+    """
+    Convert a shuffled input line to a bag of actions: a dictionary from
+    action tuples (a single word or a BNP) to counts.
+    """
+    bow = {}
+
+    in_bnp = False
+    cur_bnp = []
+    for w in line.strip().split():
+        if w == "<sonp>":
+            in_bnp = True
+            cur_bnp = []
+            continue
+        if w == "<eonp>":
+            in_bnp = False
+            if not no_npsyms_as_words:
+                cur_bnp = ["<sonp>"] + cur_bnp + ["<eonp>"]
+            write = tuple(cur_bnp)
+        else:
+            write = (w,)
+
+        if in_bnp:
+            cur_bnp.append(w)
+            continue
+
+        bow.setdefault(write, 0)
+        bow[write] += 1
+
+    return bow
+
+# The Decoder and arguments of the worker processes. These are set by
+# init_worker() before the pool forks, so the models are loaded once and
+# shared. Each worker has its own copy of the LM score cache.
+_worker_args = None
+
+# A bag of words to re-order, with the words and actions of a sentence
+# interned: words holds the distinct words, each action (a single word or a
+# BNP) is a tuple of indices into words, and counts gives the number of times
+# each action occurs.
+Bag = namedtuple("Bag", ["words", "actions", "counts"])
+
+def intern_bow(bow):
+    """
+    Convert a bag of actions, as returned by read_bow(), to a Bag.
+    """
+    words = []
+    word_ids = {}
+    actions = []
+    for action in bow:
+        for w in action:
+            if w not in word_ids:
+                word_ids[w] = len(words)
+                words.append(intern(w))
+        actions.append(tuple(word_ids[w] for w in action))
+    return Bag(words, actions, tuple(bow[a] for a in bow))
+
+class Decoder(object):
+    """
+    Re-orders shuffled sentences with a loaded n-gram LM and, optionally, a
+    FutureTable for future costs, so the models are only loaded once. The
+    other arguments are decoding options, as on the command line (budget is
+    a Budget, or None).
+    """
+
+    def __init__(self, lm, futurelm=None, no_npsyms_as_words=False,
+        engine="python", recombine=False, lm_cache=0, threshold=None,
+        beam_per_word=0, budget=None, astar_weight=1.0,
+        max_nodes=DEFAULT_MAX_NODES, node_budget=None):
+        self.lm = lm
+        self.futurelm = futurelm
+        self.no_npsyms_as_words = no_npsyms_as_words
+        self.engine = engine
+        self.recombine = recombine
+        self.cache = None
+        if lm_cache > 0:
+            self.cache = ScoreCache(lm_cache)
+        self.threshold = threshold
+        self.beam_per_word = beam_per_word
+        self.budget = budget
+        self.astar_weight = astar_weight
+        self.max_nodes = max_nodes
+        self.node_budget = node_budget
+
+    @staticmethod
+    def load(lm_path, future_path="", load_method="lazy",
+        future_heuristic="unigram", **options):
+        """
+        Load the LM (arpa or KenLM binary) and, unless future_path is empty,
+        the unigram LM for future costs, and return a Decoder with options.
+        With the "bigram" future_heuristic, future costs are estimated with
+        the LM instead (see BigramFuture), and future_path is not used.
+        """
+        lm = load_lm(lm_path, load_method)
+        futurelm = None
+        if future_heuristic == "bigram":
+            futurelm = BigramFuture(lm)
+        elif future_path != "":
+            futurelm = load_futurelm(future_path)
+        return Decoder(lm, futurelm, **options)
+
+    def engine_options(self):
+        """
+        The keyword options of the search engine, beyond those shared by all
+        of the ENGINES.
+        """
+        if self.engine == "astar":
+            return {"weight": self.astar_weight, "max_nodes": self.max_nodes,
+                "node_budget": self.node_budget}
+        return {}
+
+    def reorder_lines(self, lines, beam_size, stats=None, profile=False,
+        nbest=0):
+        """
+        Re-order shuffled input lines (with BNPs marked as in the input
+        file), decoded together as a batch, and return the output lines, or
+        with nbest, the n-best list of each line as a list of (output line,
+        LM score, future score) tuples. stats, if given, is a list with a
+        statistics dictionary for each line (see generate()).
+        """
+        bags = [intern_bow(read_bow(line, self.no_npsyms_as_words))
+            for line in lines]
+        if stats is None:
+            stats = [None] * len(bags)
+        beam_sizes = [scheduled_beam_size(beam_size, bag, self.beam_per_word)
+            for bag in bags]
+        if profile:
+            for bag, bag_stats in zip(bags, stats):
+                if bag_stats is not None:
+                    bag_stats["words"] = sum([c*len(action)
+                        for action, c in zip(bag.actions, bag.counts)])
+        if self.engine == "python":
+            outputs = generate_batch(self.lm, bags, beam_sizes, self.futurelm,
+                self.recombine, stats, self.cache, self.threshold,
+                self.budget, profile, nbest)
+        else:
+            options = self.engine_options()
+            outputs = [ENGINES[self.engine](self.lm, bag, bag_beam_size,
+                self.futurelm, self.recombine, bag_stats, self.cache,
+                self.threshold, self.budget, profile, nbest, **options)
+                for bag, bag_beam_size, bag_stats in zip(bags, beam_sizes,
+                stats)]
+        if nbest:
+            return [[(" ".join(words), score, future_score)
+                for words, score, future_score in output]
+                for output in outputs]
+        return [" ".join(output) for output in outputs]
+
+    def reorder(self, tokens, beam_size, stats=None, nbest=0):
+        """
+        Re-order a list of shuffled tokens (with BNPs marked as in the input
+        file), and return the words in order, or with nbest, a list of the
+        (words, LM score, future score) of the nbest best orderings.
+        """
+        outputs = self.reorder_lines([" ".join(tokens)], beam_size,
+            None if stats is None else [stats], nbest=nbest)
+        if nbest:
+            return [(line.split(), score, future_score)
+                for line, score, future_score in outputs[0]]
+        return outputs[0].split()
+
+def init_worker(lm, futurelm, args):
+    global _worker_args
+    budget = None
+    if args.max_seconds is not None or args.max_expansions is not None:
+        budget = Budget(args.max_seconds, args.max_expansions,
+            args.fallback_beam)
+    decoder = Decoder(lm, futurelm, args.no_npsyms_as_words, args.engine,
+        args.recombine, args.lm_cache, args.threshold, args.beam_per_word,
+        budget, args.astar_weight, args.max_nodes, args.node_budget)
+    _worker_args = (decoder, args)
+
+def decode_batch(items):
+    """
+    Re-order a batch of shuffled input lines, given as a list of tuples of
+    the index of each line and the line. Returns a list of tuples of the
+    index, the output line, a dictionary of decoding statistics and the
+    n-best list (with --nbest, and None otherwise).
+    """
+    decoder, args = _worker_args
+    stats = [{} for item in items]
+    outputs = decoder.reorder_lines([line for index, line in items],
+        args.beamsize, stats, args.profile != "", args.nbest)
+    if args.nbest:
+        return [(index, nbest[0][0], bag_stats, nbest) for (index, line),
+            nbest, bag_stats in zip(items, outputs, stats)]
+    return [(index, output, bag_stats, None) for (index, line), output,
+        bag_stats in zip(items, outputs, stats)]
+
+def decode_request(request):
+    """
+    Re-order the lines of a server request, given as a tuple of the lines and
+    the beam size, and return the output lines.
+    """
+    decoder, args = _worker_args
+    lines, beam_size = request
+    return decoder.reorder_lines(lines, beam_size)
+
+class DecoderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server that re-orders the shuffled lines of each POST request
+    (see the module documentation). Requests are handled in threads, and
+    their lines are decoded in batches of batch_size, by the worker pool if
+    there is one.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, beam_size, batch_size, pool=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+            DecoderRequestHandler)
+        self.beam_size = beam_size
+        self.batch_size = batch_size
+        self.pool = pool
+
+    def decode(self, lines, beam_size):
+        requests = [(lines[i:i+self.batch_size], beam_size)
+            for i in range(0, len(lines), self.batch_size)]
+        if self.pool is not None:
+            results = self.pool.map(decode_request, requests)
+        else:
+            results = [decode_request(request) for request in requests]
+        return [output for outputs in results for output in outputs]
+
+class DecoderRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        try:
+            beam_size = int(query.get("beam_size", [self.server.beam_size])[0])
+            length = int(self.headers.getheader("Content-Length", 0))
+        except ValueError:
+            self.send_error(400, "Invalid beam_size or Content-Length")
+            return
+        if beam_size < 1:
+            self.send_error(400, "beam_size must be at least 1")
+            return
+        lines = self.rfile.read(length).splitlines()
+        try:
+            outputs = self.server.decode(lines, beam_size)
+        except Exception as e:
+            self.send_error(500, "Decoding failed: %s" % e)
+            return
+        body = "".join(output + "\n" for output in outputs)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(args):
+    """
+    Run a DecoderServer on args.serve until interrupted.
+    """
+    pool = None
+    if args.workers > 1:
+        # Interrupts are handled by the server process, which stops the
+        # workers.
+        pool = multiprocessing.Pool(args.workers, signal.signal,
+            (signal.SIGINT, signal.SIG_IGN))
+    server = DecoderServer((args.host, args.serve), args.beamsize,
+        args.batch_size, pool)
+    sys.stderr.write("Serving on http://%s:%d/\n" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def estimated_cost(bag, beam_size):
+    """
+    An estimate of the work of decoding bag with a beam size of beam_size:
+    the number of words (search steps), times the beam size, times the
+    number of distinct actions (the candidates of each hypothesis).
+    """
+    n = sum([c*len(action) for action, c in zip(bag.actions, bag.counts)])
+    return n * beam_size * len(bag.actions)
+
+def cost_batches(items, args):
+    """
+    Sort (index, line) items by estimated cost, most costly first, and group
+    them in batches of args.batch_size, so that sentences of similar cost are
+    decoded together.
+    """
+    costs = {}
+    for index, line in items:
+        bag = intern_bow(read_bow(line, args.no_npsyms_as_words))
+        costs[index] = estimated_cost(bag, scheduled_beam_size(args.beamsize,
+            bag, args.beam_per_word))
+    items = sorted(items, key=lambda item: (-costs[item[0]], item[0]))
+    return [items[i:i+args.batch_size]
+        for i in range(0, len(items), args.batch_size)]
+
+def in_index_order(results, indices):
+    """
+    Iterate over results (tuples starting with a line index) in the order of
+    indices, keeping those that arrive early until they are due.
+    """
+    early = {}
+    for index in indices:
+        while index not in early:
+            result = next(results)
+            early[result[0]] = result
+        yield early.pop(index)
+
+def read_input(path):
+    """
+    Iterate over the lines of path, or of standard in if path is "-". Lines
+    from standard in are read as they arrive, so the decoder can be used in
+    a pipeline.
+    """
+    if path == "-":
+        return iter(sys.stdin.readline, "")
+    return open(path)
+
+def read_output_file(path):
+    """
+    Read the lines written to an output file by an earlier run, as a
+    dictionary from line index to output line. An incomplete last line (of
+    a run that was interrupted while writing it) is removed from the file.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind("\n") + 1
+        if end < len(data):
+            f.truncate(end)
+
+    for l in data[:end].splitlines():
+        index, output = l.split("\t", 1)
+        done[int(index)] = output
+    return done
+
+def trim_nbest_file(path, done):
+    """
+    Keep only the n-best entries, in an n-best file written by an earlier
+    run, of the lines in done (as read by read_output_file()). The entries
+    of a line are written before its output line, so an interrupted run can
+    leave entries for a line that will be decoded again.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        lines = f.read().splitlines(True)
+        kept = [l for l in lines if l.endswith("\n") and
+            int(l.split(" ||| ", 1)[0]) in done]
+        if len(kept) < len(lines):
+            f.seek(0)
+            f.writelines(kept)
+            f.truncate()
+
+class BagCache(object):
+    """
+    The outputs of decoded sentences, keyed by their bag of actions (sorted,
+    with their counts), so that sentences with the same bag are not decoded
+    again. settings holds the decoding settings the outputs depend on. With
+    a path, the outputs decoded with the same settings in earlier runs are
+    read from that file, and new ones are appended to it.
+    """
+
+    def __init__(self, settings, path=""):
+        self.settings = hashlib.md5(json.dumps(settings,
+            sort_keys=True)).hexdigest()
+        self.outputs = {}
+        self.served = 0
+        self.file = None
+        if path == "":
+            return
+        if os.path.exists(path):
+            for l in open(path):
+                fields = l.rstrip("\n").split("\t")
+                # Skip the incomplete last line of an interrupted run.
+                if l.endswith("\n") and len(fields) == 3 \
+                    and fields[0] == self.settings:
+                    self.outputs[fields[1]] = fields[2]
+        self.file = open(path, "a")
+
+    @staticmethod
+    def key(bow):
+        """
+        The key of a bag of actions, as returned by read_bow().
+        """
+        return "\x00".join("%d\x01%s" % (bow[action], " ".join(action))
+            for action in sorted(bow))
+
+    def add(self, key, output):
+        self.outputs[key] = output
+        if self.file is not None:
+            self.file.write("%s\t%s\t%s\n" % (self.settings, key, output))
+            self.file.flush()
+
+def format_nbest(index, nbest):
+    """
+    Format an n-best list, as returned by Decoder.reorder_lines(), with one
+    line per hypothesis: the line index, the output line, the LM score and
+    the future score, and their sum, separated by |||.
+    """
+    return "".join("%d ||| %s ||| %f %f ||| %f\n" % (index, line, score,
+        future_score, score + future_score)
+        for line, score, future_score in nbest)
+
+def write_output_line(fd, index, output):
+    """
+    Append a line with its index to the output file, with a single write.
+    """
+    os.write(fd, "%d\t%s\n" % (index, output))
+
+# Columns of the --profile file. The peak_ columns are maximums over the
+# sentences in the total, and the others are sums.
+PROFILE_FIELDS = ["index", "words", "seconds", "lm_calls", "expansions",
+    "candidates", "admitted", "lm_seconds", "future_seconds", "beam_seconds",
+    "peak_hypotheses", "peak_bytes"]
+
+def write_profile(path, rows):
+    """
+    Write the profile rows of the decoded sentences (dictionaries with the
+    PROFILE_FIELDS), with their total, to path: as CSV if it ends in .csv
+    (with the total as a last row with index "all"), and as JSON otherwise.
+    """
+    total = {"index": "all"}
+    for field in PROFILE_FIELDS[1:]:
+        values = [row[field] for row in rows]
+        if field.startswith("peak_"):
+            total[field] = max(values or [0])
+        else:
+            total[field] = sum(values)
+    with open(path, "w") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, PROFILE_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows + [total])
+        else:
+            json.dump({"sentences": rows, "total": total}, f, indent=1,
+                sort_keys=True)
+            f.write("\n")
+
+def report_stats(label, stats, args):
+    if stats.get("fallbacks", 0) > 0:
+        sys.stderr.write("%s: search budget exhausted in %d sentence(s), "
+            "%d steps decoded with beam size %d\n" % (label,
+            stats["fallbacks"], stats["fallback_steps"], args.fallback_beam))
+    if args.recombine:
+        admitted = stats.get("admitted", 0)
+        recombined = stats.get("recombined", 0)
+        sys.stderr.write("%s: recombined %d of %d hypotheses "
+            "(%.2f%%)\n" % (label, recombined, admitted,
+            100.0 * recombined / max(admitted, 1)))
+    if args.lm_cache > 0:
+        hits = stats.get("lm_cache_hits", 0)
+        queries = hits + stats.get("lm_cache_misses", 0)
+        sys.stderr.write("%s: LM cache hits %d of %d queries (%.2f%%)\n" % (
+            label, hits, queries, 100.0 * hits / max(queries, 1)))
 
 def main(arguments):
 
@@ -144,54 +1806,307 @@ def main(arguments):
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    parser.add_argument('lm', help="Language model", type=str)    
+    parser.add_argument('lm', help="Language model (arpa or KenLM binary)",
+        type=str)    
     parser.add_argument('test', help="Shuffled file (one sentence per line, no \
-        EOS symbols, to re-order.", type=str)
-    parser.add_argument('beamsize', help="Beam size to use.", type=int)
+        EOS symbols, to re-order. Use - to read from standard in.", type=str)
+    parser.add_argument('beamsize', help="Beam size to use (the maximum beam \
+        size, with --beam_per_word).", type=int)
     parser.add_argument('-f', '--future', help="LM for unigram future costs. \
         If omitted, future costs are not calculated.", type=str, default="")
+    parser.add_argument('--future_heuristic', help="How future costs are \
+        estimated: unigram, from the --future LM, or bigram, from the LM \
+        itself, with the first word of each action scored after the best \
+        context word for it in the sentence (which does not need --future).",
+        choices=["unigram", "bigram"], default="unigram")
     
     parser.add_argument('-n', '--no_npsyms_as_words',
         help="Do not treat base NP symbols as words.", action="store_true")
+    parser.add_argument('-w', '--workers', help="Number of worker processes \
+        used to decode sentences in parallel.", type=int, default=1)
+    parser.add_argument('--chunk_size', help="Number of batches of sentences \
+        (see --batch_size) sent to a worker process at a time (with \
+        --workers and --schedule input).", type=int, default=8)
+    parser.add_argument('--schedule', help="Order in which the sentences are \
+        decoded: input, as they are read, or cost, most costly first, after \
+        reading the whole input (see above).", choices=["input", "cost"],
+        default="input")
+    parser.add_argument('--batch_size', help="Number of sentences decoded \
+        together, with their beam searches run in lockstep so that their LM \
+        queries are made together (with --engine python). Input from \
+        standard in is decoded once a batch has been read.", type=int,
+        default=1)
+    parser.add_argument('-e', '--engine', help="Search implementation: \
+        python, numpy, a beam search which scores and selects the candidates \
+        of each step with NumPy array operations (and requires NumPy), or \
+        astar, a best-first search (see above).",
+        choices=sorted(ENGINES), default="python")
+    parser.add_argument('--astar_weight', help="Weight of the future score \
+        in the priority of a node, with --engine astar. Weights above 1 give \
+        a greedier, faster search.", type=float, default=1.0)
+    parser.add_argument('--max_nodes', help="Maximum number of open nodes \
+        kept by the best-first search (with --engine astar).", type=int,
+        default=DEFAULT_MAX_NODES)
+    parser.add_argument('--node_budget', help="Maximum number of nodes \
+        scored by the best-first search of a sentence (with --engine astar), \
+        after which the best open node is completed greedily. By default, %d \
+        times --max_nodes." % NODE_BUDGET_FACTOR, type=int, default=None)
+    parser.add_argument('-t', '--threshold', help="Also prune the \
+        hypotheses of each beam whose score (plus future score) is more than \
+        this many log10 units below the best one. By default, only the beam \
+        size is used.", type=float, default=None)
+    parser.add_argument('--beam_per_word', help="If positive, the beam size \
+        of a sentence is this times its number of words (rounded up), up to \
+        beamsize.", type=float, default=0)
+    parser.add_argument('--max_seconds', help="Search budget of a sentence, \
+        in seconds. Once it is used up, the rest of the sentence is decoded \
+        with a beam size of --fallback_beam, and this is logged to standard \
+        error.", type=float, default=None)
+    parser.add_argument('--max_expansions', help="Search budget of a \
+        sentence, in candidate hypotheses scored (see --max_seconds).",
+        type=int, default=None)
+    parser.add_argument('--fallback_beam', help="Beam size used once the \
+        search budget of a sentence is used up. With 1, the best hypothesis \
+        so far is completed greedily.", type=int, default=1)
+    parser.add_argument('-r', '--recombine', help="Merge hypotheses with the \
+        same remaining bag and LM state, keeping the best one. The \
+        recombination rate of each sentence is written to standard error.",
+        action="store_true")
+    parser.add_argument('-c', '--lm_cache', help="Size (in entries) of a \
+        cache of LM scores, keyed by LM state and word, kept by each worker. \
+        The cache hit rate of each sentence is written to standard error. \
+        If 0, the cache is not used.", type=int, default=0)
+    parser.add_argument('-o', '--output', help="File to which each output \
+        line is appended (with its line index) as soon as it is decoded. \
+        Lines already in this file are not decoded again.", type=str,
+        default="")
+    parser.add_argument('-b', '--binary', help="Convert the arpa language \
+        model to a KenLM binary model (cached next to the arpa file) and \
+        decode with that.", action="store_true")
+    parser.add_argument('--binary_type', help="Type of the binary model \
+        built with --binary.", choices=["probing", "trie"], default="trie")
+    parser.add_argument('--build_binary', help="Path of KenLM's build_binary \
+        program, used with --binary.", type=str, default="build_binary")
+    parser.add_argument('--nbest', help="Also write the N best orderings of \
+        each sentence in the last beam (with their LM and future scores) to \
+        --nbest_file.", type=int, default=0)
+    parser.add_argument('--nbest_file', help="File to which the n-best lists \
+        are written (with --nbest), one hypothesis per line as: line index \
+        ||| output ||| LM score, future score ||| total score. With \
+        --output, it is appended to, and the entries of lines missing from \
+        the --output file are removed first.", type=str, default="")
+    parser.add_argument('-d', '--dedup', help="Decode each distinct bag of \
+        words (and BNPs) only once, and output the same ordering for \
+        sentences with the same bag. The number of sentences served this \
+        way is written to standard error.", action="store_true")
+    parser.add_argument('--bag_cache', help="File in which the orderings of \
+        the bags decoded with --dedup are stored, and from which they are \
+        served in later runs with the same models and settings. Implies \
+        --dedup.", type=str, default="")
+    parser.add_argument('-p', '--profile', help="File to which a profile of \
+        each sentence and of the whole run is written: the time taken, the \
+        calls to KenLM's BaseScore, the hypotheses (or A* nodes) expanded, \
+        the candidates scored and admitted, the \
+        time spent on LM queries, future costs and the beams, and the peak \
+        number (and estimated size) of the hypotheses held. Written as CSV \
+        if the file name ends in .csv, and as JSON otherwise.", type=str,
+        default="")
+    parser.add_argument('-s', '--serve', help="Instead of decoding the test \
+        file, serve re-ordering requests over HTTP on this port (see above).",
+        type=int, default=None)
+    parser.add_argument('--host', help="Address the server listens on (with \
+        --serve).", type=str, default="127.0.0.1")
+    parser.add_argument('-l', '--load_method', help="How to load a binary \
+        language model.", choices=sorted(LOAD_METHODS), default="lazy")
         
     args = parser.parse_args(arguments)
-    lm = kenlm.Model(args.lm)
+    if args.threshold is not None and args.threshold <= 0:
+        parser.error("--threshold must be positive")
+    if args.nbest < 0:
+        parser.error("--nbest must not be negative")
+    if (args.nbest > 0) != (args.nbest_file != ""):
+        parser.error("--nbest and --nbest_file must be used together")
+    if args.future_heuristic == "bigram" and args.future != "":
+        parser.error("--future is not used with --future_heuristic bigram")
+    if args.bag_cache != "":
+        args.dedup = True
+    if args.dedup and args.nbest > 0:
+        parser.error("--dedup does not support --nbest")
+    if args.fallback_beam < 1:
+        parser.error("--fallback_beam must be at least 1")
+    if args.batch_size < 1:
+        parser.error("--batch_size must be at least 1")
+    if args.engine == "numpy" and np is None:
+        parser.error("--engine numpy requires NumPy")
+    if args.engine == "numpy" and args.recombine:
+        parser.error("--engine numpy does not support --recombine")
+    if args.engine == "astar" and args.threshold is not None:
+        parser.error("--engine astar does not support --threshold")
+    if args.astar_weight <= 0:
+        parser.error("--astar_weight must be positive")
+    if args.max_nodes < 1:
+        parser.error("--max_nodes must be at least 1")
+    if args.node_budget is not None and args.node_budget < 1:
+        parser.error("--node_budget must be at least 1")
+    lm_path = args.lm
+    if args.binary:
+        lm_path = build_binary_lm(args.lm, args.binary_type,
+            args.build_binary)
+    lm = load_lm(lm_path, args.load_method)
     
-    futurelm = {}
-    if args.future != "":
-        for l in open(args.future):
-            t = l.strip().split()
-            if len(t) == 2 and t[0] != "ngram":        
-                futurelm[t[1]] = float(t[0])
+    futurelm = None
+    if args.future_heuristic == "bigram":
+        futurelm = BigramFuture(lm)
+    elif args.future != "":
+        futurelm = load_futurelm(args.future)
 
-    for l in open(args.test):
+    init_worker(lm, futurelm, args)
+    if args.serve is not None:
+        serve(args)
+        return
 
-        bow = {}
+    done = {}
+    output_fd = None
+    if args.output != "":
+        done = read_output_file(args.output)
+        output_fd = os.open(args.output, os.O_WRONLY | os.O_APPEND |
+            os.O_CREAT, 0644)
 
-        in_bnp = False
-        cur_bnp = []
-        for w in l.strip().split():
-            if w == "<sonp>":
-                in_bnp = True
-                cur_bnp = []
-                continue
-            if w == "<eonp>":
-                in_bnp = False
-                if not args.no_npsyms_as_words:
-                    cur_bnp = ["<sonp>"] + cur_bnp + ["<eonp>"]
-                write = tuple(cur_bnp)
-            else:
-                write = (w,)
+    nbest_file = None
+    if args.nbest > 0:
+        if args.output != "":
+            trim_nbest_file(args.nbest_file, done)
+        nbest_file = open(args.nbest_file, "a" if args.output != "" else "w")
 
-            if in_bnp:
-                cur_bnp.append(w)
-                continue
+    # The n-best entries of a line are written before its output line, so
+    # that a line in the output file has all of its entries.
+    def write_result(index, output, nbest):
+        if nbest_file is not None:
+            nbest_file.write(format_nbest(index, nbest))
+            nbest_file.flush()
+        if output_fd is not None:
+            write_output_line(output_fd, index, output)
+
+    bag_cache = None
+    if args.dedup:
+        settings = dict((k, v) for k, v in vars(args).iteritems() if k in [
+            "future", "future_heuristic", "beamsize", "no_npsyms_as_words",
+            "engine", "recombine", "threshold", "beam_per_word",
+            "max_seconds", "max_expansions", "fallback_beam", "astar_weight",
+            "max_nodes", "node_budget"])
+        for k, path in [("lm", lm_path), ("future", args.future)]:
+            if path != "":
+                settings[k] = (os.path.abspath(path), os.path.getmtime(path))
+        bag_cache = BagCache(settings, args.bag_cache)
+    # The bag cache keys of the sentences being decoded, and of those that
+    # are served from the bag cache (whose bags were decoded for an earlier
+    # line). With --workers, the input is read in another thread.
+    pending = {}
+    decoding = set()
+    served = {}
+
+    test_file = read_input(args.test)
+    lines_read = [0]
+    def read_items():
+        for index, l in enumerate(test_file):
+            lines_read[0] = index + 1
+            if bag_cache is not None:
+                key = BagCache.key(read_bow(l, args.no_npsyms_as_words))
+                if index in done:
+                    bag_cache.outputs.setdefault(key, done[index])
+                    continue
+                if key in bag_cache.outputs or key in decoding:
+                    served[index] = key
+                    continue
+                pending[index] = key
+                decoding.add(key)
+            if index not in done:
+                yield index, l
+    def read_batches():
+        batch = []
+        for item in read_items():
+            batch.append(item)
+            if len(batch) == args.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    if args.schedule == "cost":
+        items = list(read_items())
+        batches = cost_batches(items, args)
+    else:
+        batches = read_batches()
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        if args.schedule == "cost":
+            results = pool.imap_unordered(decode_batch, batches)
+        else:
+            results = pool.imap(decode_batch, batches, args.chunk_size)
+    else:
+        results = (decode_batch(batch) for batch in batches)
+    results = itertools.chain.from_iterable(results)
+    if args.schedule == "cost":
+        # Lines are written to the output file as soon as they are decoded,
+        # so that they are not decoded again after a crash, even if they
+        # are printed much later.
+        def journal(results):
+            for index, output, stats, nbest in results:
+                write_result(index, output, nbest)
+                yield index, output, stats, nbest
+        results = in_index_order(journal(results), sorted([index
+            for index, line in items]))
+
+    def skipped_output(index):
+        if index in done:
+            return done[index]
+        output = bag_cache.outputs[served.pop(index)]
+        bag_cache.served += 1
+        if output_fd is not None:
+            write_output_line(output_fd, index, output)
+        return output
 
-            bow.setdefault(write, 0)
-            bow[write] += 1
+    totals = {}
+    profile_rows = []
+    next_index = 0
+    for index, output, stats, nbest in results:
+        if args.schedule != "cost":
+            write_result(index, output, nbest)
+        while next_index < index:
+            print skipped_output(next_index)
+            next_index += 1
+        print output
+        sys.stdout.flush()
+        next_index += 1
+        if bag_cache is not None:
+            key = pending.pop(index)
+            bag_cache.add(key, output)
+            decoding.discard(key)
+        report_stats("sentence %d" % index, stats, args)
+        if args.profile != "":
+            row = dict((field, stats.get(field, 0))
+                for field in PROFILE_FIELDS)
+            row["index"] = index
+            profile_rows.append(row)
+        for k, v in stats.iteritems():
+            totals[k] = totals.get(k, 0) + v
+    while next_index < lines_read[0]:
+        print skipped_output(next_index)
+        next_index += 1
 
-        print " ".join(generate(lm, bow, args.beamsize, futurelm))
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    if output_fd is not None:
+        os.close(output_fd)
+    if nbest_file is not None:
+        nbest_file.close()
 
+    report_stats("all sentences", totals, args)
+    if bag_cache is not None:
+        sys.stderr.write("all sentences: %d of %d served from the bag cache\n"
+            % (bag_cache.served, lines_read[0]))
+    if args.profile != "":
+        write_profile(args.profile, profile_rows)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))